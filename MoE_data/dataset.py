@@ -13,322 +13,755 @@ Usage:
     python dataset.py --all
     python dataset.py --dataset docvqa
     python dataset.py --dataset cord
+    python dataset.py --dataset docmatix --image-format jpeg
+    python dataset.py --dataset docmatix --output-format webdataset
+    python dataset.py --dataset docmatix --output-format parquet
+    python dataset.py --dataset docmatix --prefetch 128
+    python dataset.py --all --jobs 1
+
+Shared cache:
+    Set HF_DATASET_CACHE_NETWORK_LOCATION to a directory on shared storage
+    (an NFS mount or a FUSE-mounted S3 bucket) to keep the Hugging Face caches
+    there. The first machine downloads from the Hub; later runs and other
+    nodes read the cached files instead.
 """
 
 import argparse
+import dataclasses
+import gc
+import importlib.util
+import io
 import json
+import os
+import queue
 import shutil
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from datasets import load_dataset
 from dotenv import load_dotenv
-from tqdm import tqdm
 
 load_dotenv()
 
+# huggingface_hub reads these when it is imported, so they must be set before
+# the datasets import below. hf_transfer splits each file into parallel range
+# requests instead of a single HTTP stream.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+else:
+    print("Warning: hf_transfer is not installed, Hub downloads use a single connection per file "
+          "(pip install hf_transfer)")
+os.environ.setdefault("HF_HUB_DOWNLOAD_TIMEOUT", "60")
+os.environ.setdefault("HF_DATASETS_TRUST_REMOTE_CODE", "0")
+
+_shared_cache = os.environ.get("HF_DATASET_CACHE_NETWORK_LOCATION")
+if _shared_cache:
+    os.environ["HF_HUB_CACHE"] = os.path.join(_shared_cache, "hub")
+    os.environ["HF_DATASETS_CACHE"] = os.path.join(_shared_cache, "datasets")
+
+from datasets import Image, load_dataset, load_dataset_builder, load_from_disk
+from huggingface_hub import hf_hub_download
+from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 OUTPUT_DIR = "data"
 
+# Metadata JSONL is written in batches to amortize write() syscalls
+JSONL_BATCH_SIZE = 1024
+WRITE_BUFFER_BYTES = 1 << 20
+
+# PNG encoding releases the GIL, so image saves run on a thread pool while the
+# main thread keeps pulling examples from the stream
+IMAGE_SAVE_WORKERS = os.cpu_count() or 4
+MAX_PENDING_SAVES = 64
+
+# zlib level 1 is several times faster than PIL's default of 6 for a modest size increase
+PNG_COMPRESS_LEVEL = 1
+JPEG_QUALITY = 90
+
+# Examples per tar shard for --output-format webdataset
+WDS_SHARD_SIZE = 1000
+
+# Rows per record batch and approximate bytes per file for --output-format parquet
+PARQUET_BATCH_ROWS = 1024
+PARQUET_FILE_BYTES = 128 << 20
+
+# Docmatix parquet shards are downloaded in parallel instead of over a single
+# HTTPS stream; up to this many shards ahead of the one being written are in
+# flight, so an early stop leaves at most this many downloads to finish
+PARQUET_PREFETCH_SHARDS = 8
+
+# Written into a dataset's directory once it has been fully downloaded, so
+# reruns load from disk instead of revalidating every file against the Hub
+DONE_MARKER = ".ok"
+
+# Streamed examples buffered ahead by a background thread (--prefetch)
+DEFAULT_PREFETCH = 64
+_PREFETCH_DONE = object()
+
+# Rows between explicit gc.collect() calls while streaming, so buffers held by
+# reference cycles (arrow batches, decoded images) are freed on a fixed cadence
+GC_INTERVAL = 1000
+
+# Independent Hub datasets downloaded side by side in worker processes (--jobs)
+DEFAULT_JOBS = 4
+
+
+def _dumps(obj, newline=False):
+    """Serialize `obj` to compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_APPEND_NEWLINE if newline else 0)
+        return orjson.dumps(obj, option=option)
+    data = json.dumps(obj, separators=(",", ":")).encode()
+    return data + b"\n" if newline else data
+
 
-def download_docvqa():
+def _flush_lines(f, lines):
+    """Write buffered JSONL lines with a single write() call."""
+    if lines:
+        f.write(b"".join(lines))
+        lines.clear()
+
+
+def _disable_image_decoding(dataset, keys):
     """
-    Download DocVQA dataset.
-    - 50,000 questions on 12,767 document images
-    - Mix of printed, typewritten, handwritten content
-    - Letters, memos, notes, reports
+    Cast image columns to Image(decode=False) so examples carry the original
+    encoded bytes ({"bytes": ..., "path": ...}) instead of decoded PIL images.
+    Falls back to the decoded dataset if the cast isn't supported.
     """
-    print("\n" + "=" * 60)
-    print("Downloading DocVQA...")
-    print("=" * 60)
-    
-    output_path = Path(OUTPUT_DIR) / "docvqa"
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    # Load from HuggingFace
-    dataset = load_dataset("HuggingFaceM4/DocumentVQA")
-    
-    print(f"Train: {len(dataset['train'])} examples")
-    print(f"Validation: {len(dataset['validation'])} examples")
-    print(f"Test: {len(dataset['test'])} examples")
-    
-    # Save
-    dataset.save_to_disk(str(output_path))
-    print(f"Saved to: {output_path}")
-    
-    # Preview
-    print("\nSample:")
-    sample = dataset['train'][0]
-    print(f"  Question: {sample.get('question', sample.get('questions', ['N/A'])[0] if isinstance(sample.get('questions'), list) else 'N/A')}")
-    print(f"  Keys: {list(sample.keys())}")
-    
+    features = getattr(dataset, "features", None)
+    if not features:
+        return dataset
+
+    for key in keys:
+        feature = features.get(key)
+        try:
+            if isinstance(feature, Image):
+                dataset = dataset.cast_column(key, Image(decode=False))
+            elif isinstance(getattr(feature, "feature", None), Image):
+                # Sequence/List of images
+                dataset = dataset.cast_column(key, dataclasses.replace(feature, feature=Image(decode=False)))
+            elif isinstance(feature, list) and len(feature) == 1 and isinstance(feature[0], Image):
+                dataset = dataset.cast_column(key, [Image(decode=False)])
+        except Exception as e:
+            print(f"  Could not disable image decoding for '{key}': {e}")
     return dataset
 
 
-def download_docmatix():
+def _image_suffix(data, source_path=None):
+    """Infer a file extension for encoded image bytes, preferring magic bytes."""
+    if data.startswith(b"\x89PNG"):
+        return ".png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if data.startswith((b"II*\x00", b"MM\x00*")):
+        return ".tif"
+    if data.startswith(b"GIF8"):
+        return ".gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if source_path and Path(source_path).suffix:
+        return Path(source_path).suffix.lower()
+    return ".bin"
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _save_pil_image(img, path, image_format):
+    """Encode a decoded PIL image to disk as fast PNG or JPEG, then release its pixel buffer."""
+    try:
+        if image_format == "jpeg":
+            with img.convert("RGB") as rgb:
+                rgb.save(path, format="JPEG", quality=JPEG_QUALITY)
+        else:
+            img.save(path, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    finally:
+        img.close()
+
+
+def _submit_image(executor, pending, img, stem, image_format="png"):
     """
-    Download Docmatix dataset (subset).
-    - 2.4 million images, 9.5 million Q/A pairs
-    - 100x larger than DocVQA
-    - We download a subset for fine-tuning
+    Queue an image for writing to `stem` + extension and return the output path,
+    or None if `img` holds no image. Encoded bytes are written as-is; only
+    decoded PIL images are re-encoded (as PNG or JPEG, per `image_format`).
     """
-    print("\n" + "=" * 60)
-    print("Downloading Docmatix (subset)...")
-    print("=" * 60)
-    
-    output_path = Path(OUTPUT_DIR) / "docmatix"
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    # Load subset (full dataset is huge)
-    # Using streaming to avoid downloading everything
-    dataset = load_dataset(
-        "HuggingFaceM4/Docmatix",
-        "images",
-        split="train",
-        streaming=True
-    )
-
-    # Save incrementally to avoid OOM — images go to disk, metadata to JSONL
-    images_dir = output_path / "images"
-    images_dir.mkdir(parents=True, exist_ok=True)
-    metadata_file = output_path / "docmatix_50k.jsonl"
+    if isinstance(img, dict):
+        data, source = img.get("bytes"), img.get("path")
+        if data:
+            path = stem + _image_suffix(data, source)
+            future = executor.submit(_write_bytes, path, data)
+        elif source and os.path.isfile(source):
+            path = stem + (Path(source).suffix.lower() or ".png")
+            future = executor.submit(shutil.copyfile, source, path)
+        else:
+            return None
+    elif hasattr(img, "save"):
+        path = stem + (".jpg" if image_format == "jpeg" else ".png")
+        future = executor.submit(_save_pil_image, img, path, image_format)
+    else:
+        return None
+
+    pending.append(future)
+    if len(pending) >= MAX_PENDING_SAVES:
+        pending.popleft().result()
+    return path
+
+
+def _drain_saves(pending):
+    """Wait for all queued image saves, re-raising the first failure."""
+    while pending:
+        pending.popleft().result()
+
+
+def _image_bytes(img, image_format="png"):
+    """Return (encoded bytes, extension) for an image item, or None if it holds no image."""
+    if isinstance(img, dict):
+        data, source = img.get("bytes"), img.get("path")
+        if not data and source and os.path.isfile(source):
+            data = Path(source).read_bytes()
+        if not data:
+            return None
+        return data, _image_suffix(data, source)
+    if hasattr(img, "save"):
+        buf = io.BytesIO()
+        _save_pil_image(img, buf, image_format)
+        return buf.getvalue(), (".jpg" if image_format == "jpeg" else ".png")
+    return None
+
+
+def _example_images(example, keys):
+    """Collect the image items stored under `keys` into a flat list."""
+    images = []
+    for key in keys:
+        img = example.get(key)
+        if img is None:
+            continue
+        images.extend(img if isinstance(img, list) else [img])
+    return images
+
+
+class _Sink:
+    """Destination for streamed examples; use as a context manager."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _FileSink(_Sink):
+    """One file per image plus a JSONL metadata sidecar."""
+
+    def __init__(self, images_dir, metadata_file, image_format="png"):
+        self.images_dir = Path(images_dir)
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+        # Plain string prefix: building Path objects per image is measurable over 50K examples
+        self._prefix = f"{self.images_dir}{os.sep}"
+        self.metadata_file = metadata_file
+        self.image_format = image_format
+        self._lines = []
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=IMAGE_SAVE_WORKERS)
+        self._f = open(metadata_file, "wb", buffering=WRITE_BUFFER_BYTES)
+
+    def write(self, example_id, images, meta):
+        saved_images = []
+        for img_idx, img in enumerate(images):
+            stem = f"{self._prefix}{example_id:06d}_{img_idx}"
+            img_path = _submit_image(self._executor, self._pending, img, stem, self.image_format)
+            if img_path:
+                saved_images.append(img_path)
+
+        meta["image_paths"] = saved_images
+        meta["example_id"] = example_id
+        self._lines.append(_dumps(meta, newline=True))
+        if len(self._lines) >= JSONL_BATCH_SIZE:
+            _flush_lines(self._f, self._lines)
+
+    def close(self):
+        try:
+            _flush_lines(self._f, self._lines)
+            _drain_saves(self._pending)
+        finally:
+            self._executor.shutdown()
+            self._f.close()
 
-    max_examples = 50000
-    print(f"Downloading first {max_examples} examples (streaming to disk)...")
+    def __str__(self):
+        return f"{self.images_dir} (images), {self.metadata_file} (metadata)"
 
-    count = 0
-    with open(metadata_file, "w") as f:
-        for example in tqdm(dataset, total=max_examples):
-            if count >= max_examples:
-                break
-
-            # Save images to disk
-            saved_images = []
-            images = example.get("images", [])
-            if not isinstance(images, list):
-                images = [images]
-            for img_idx, img in enumerate(images):
-                img_path = images_dir / f"{count:06d}_{img_idx}.png"
-                if hasattr(img, "save"):
-                    img.save(str(img_path))
-                    saved_images.append(str(img_path))
-
-            # Write metadata (without image data) as a JSONL line
-            meta = {k: v for k, v in example.items() if k != "images"}
-            meta["image_paths"] = saved_images
-            meta["example_id"] = count
-            f.write(json.dumps(meta) + "\n")
-
-            count += 1
 
-    print(f"Downloaded: {count} examples")
-    print(f"Images saved to: {images_dir}")
-    print(f"Metadata saved to: {metadata_file}")
+class _WebDatasetSink(_Sink):
+    """
+    Sharded WebDataset tar archives. Each example is stored contiguously as
+    {key}.{img_idx}.{ext} image members plus a {key}.json metadata member,
+    which keeps inode count low and reads sequential for the trainer.
+    """
 
-    return count
+    def __init__(self, pattern, image_format="png"):
+        import webdataset as wds
+
+        self.pattern = pattern
+        self.image_format = image_format
+        self._writer = wds.ShardWriter(pattern, maxcount=WDS_SHARD_SIZE, verbose=0)
+
+    def write(self, example_id, images, meta):
+        sample = {"__key__": f"{example_id:06d}"}
+        for img_idx, img in enumerate(images):
+            encoded = _image_bytes(img, self.image_format)
+            if encoded:
+                data, suffix = encoded
+                sample[f"{img_idx}{suffix}"] = data
+
+        meta["example_id"] = example_id
+        sample["json"] = _dumps(meta)
+        self._writer.write(sample)
+
+    def close(self):
+        self._writer.close()
+
+    def __str__(self):
+        return self.pattern
 
 
-def download_cord():
+class _ParquetSink(_Sink):
     """
-    Download CORD dataset (receipts/invoices).
-    - 11,000+ Indonesian receipts
-    - 30 semantic classes, 5 superclasses
-    - Menu items, totals, subtotals
+    Parquet files with the encoded images embedded in a list<binary> column and
+    the remaining fields as a JSON string, rolled over at ~PARQUET_FILE_BYTES.
+    Trainers read them with pyarrow.dataset / datasets without per-image opens.
     """
+
+    def __init__(self, pattern, image_format="png"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+        self.pattern = pattern
+        self.image_format = image_format
+        self._schema = pa.schema([
+            ("example_id", pa.int64()),
+            ("images", pa.list_(pa.binary())),
+            ("meta", pa.string()),
+        ])
+        self._columns = {"example_id": [], "images": [], "meta": []}
+        self._writer = None
+        self._shard = 0
+        self._file_bytes = 0
+        self._batch_bytes = 0
+
+    def write(self, example_id, images, meta):
+        encoded = [e[0] for e in (_image_bytes(img, self.image_format) for img in images) if e]
+        meta_json = _dumps(meta).decode()
+
+        self._columns["example_id"].append(example_id)
+        self._columns["images"].append(encoded)
+        self._columns["meta"].append(meta_json)
+        self._batch_bytes += sum(map(len, encoded)) + len(meta_json)
+        if len(self._columns["example_id"]) >= PARQUET_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns["example_id"]:
+            return
+        if self._writer is None:
+            path = self.pattern % self._shard
+            self._writer = self._pq.ParquetWriter(path, self._schema)
+        batch = self._pa.RecordBatch.from_pydict(self._columns, schema=self._schema)
+        self._writer.write_batch(batch)
+        self._file_bytes += self._batch_bytes
+        self._columns = {"example_id": [], "images": [], "meta": []}
+        self._batch_bytes = 0
+
+        if self._file_bytes >= PARQUET_FILE_BYTES:
+            self._writer.close()
+            self._writer = None
+            self._shard += 1
+            self._file_bytes = 0
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __str__(self):
+        return self.pattern
+
+
+def _open_sink(output_format, output_path, name, images_dir, image_format="png"):
+    """Create the sink for `output_format` ("files", "webdataset" or "parquet")."""
+    if output_format == "webdataset":
+        return _WebDatasetSink(str(output_path / f"{name}-%06d.tar"), image_format)
+    if output_format == "parquet":
+        return _ParquetSink(str(output_path / f"{name}-%05d.parquet"), image_format)
+    return _FileSink(images_dir, output_path / f"{name}.jsonl", image_format)
+
+
+def _prefetch(iterable, size):
+    """
+    Iterate `iterable` on a background thread, keeping up to `size` items
+    buffered so network waits overlap with writing the previous examples.
+    Errors raised by the source are re-raised in the consumer; size <= 0
+    iterates in the calling thread.
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    buf = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        # Give up once the consumer has stopped (e.g. max_examples reached)
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            errors.append(e)
+        put(_PREFETCH_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buf.get()
+            if item is _PREFETCH_DONE:
+                if errors:
+                    raise errors[0]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _list_parquet_shards(repo_id, config_name, split="train"):
+    """Resolve the parquet files backing a Hub dataset config, as repo-relative paths."""
+    builder = load_dataset_builder(repo_id, config_name)
+    urls = builder.config.data_files[split]
+    # URLs look like hf://datasets/{repo_id}@{revision}/{path}
+    paths = [url.split(repo_id, 1)[1].split("/", 1)[1] for url in urls]
+    return sorted(p for p in paths if p.endswith(".parquet"))
+
+
+def _download_shard(repo_id, shard):
+    """Download one parquet shard into the Hub cache and return its local path."""
+    return hf_hub_download(repo_id=repo_id, filename=shard, repo_type="dataset")
+
+
+def _stream_parquet_shards(repo_id, shards, image_keys):
+    """
+    Yield examples from `shards` in order, each streamed from local disk once
+    downloaded. One future per shard keeps the next PARQUET_PREFETCH_SHARDS
+    downloading in the background while the current one is consumed. When the
+    caller stops early, futures that haven't started are cancelled; the ones
+    already downloading still finish before the interpreter exits (the
+    executor's exit hook joins its threads).
+    """
+    executor = ThreadPoolExecutor(max_workers=PARQUET_PREFETCH_SHARDS)
+    pending = deque()
+    submitted = 0
+    try:
+        while submitted < len(shards) or pending:
+            while submitted < len(shards) and len(pending) <= PARQUET_PREFETCH_SHARDS:
+                pending.append(executor.submit(_download_shard, repo_id, shards[submitted]))
+                submitted += 1
+
+            stream = load_dataset(
+                "parquet",
+                data_files=[pending.popleft().result()],
+                split="train",
+                streaming=True
+            )
+            yield from _disable_image_decoding(stream, image_keys)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _read_done_marker(output_path):
+    """Return the info recorded for a completed download, or None."""
+    marker = Path(output_path) / DONE_MARKER
+    if not marker.exists():
+        return None
+    try:
+        return json.loads(marker.read_text() or "{}")
+    except ValueError:
+        return None
+
+
+def _write_done_marker(output_path, **info):
+    """Mark a download as complete, recording `info` for later runs."""
+    (Path(output_path) / DONE_MARKER).write_text(json.dumps(info))
+
+
+def _stream_and_persist(stream, sink, image_keys, max_examples=None, prefetch=0, desc=None):
+    """
+    Write examples from `stream` to `sink` (images split out under `image_keys`,
+    everything else kept as metadata) and return how many were written.
+    """
+    total = max_examples if max_examples is not None else getattr(stream, "__len__", lambda: None)()
+
+    count = 0
+    for example in tqdm(_prefetch(stream, prefetch), desc=desc, total=total):
+        if max_examples is not None and count >= max_examples:
+            break
+
+        images = _example_images(example, image_keys)
+        meta = {k: v for k, v in example.items() if k not in image_keys}
+        sink.write(count, images, meta)
+        del example, images, meta
+
+        count += 1
+        if count % GC_INTERVAL == 0:
+            gc.collect()
+
+    return count
+
+
+def _print_header(title):
     print("\n" + "=" * 60)
-    print("Downloading CORD (Receipt Dataset)...")
+    print(title)
     print("=" * 60)
-    
-    output_path = Path(OUTPUT_DIR) / "cord"
+
+
+def _download_hf(cfg):
+    """
+    Download a Hub dataset described by a DATASETS entry and save it to disk.
+    Repos in cfg["hf"] are tried in order until one loads.
+    """
+    _print_header(f"Downloading {cfg['name']}...")
+
+    output_path = Path(OUTPUT_DIR) / cfg["id"]
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    # Try different versions
-    try:
-        dataset = load_dataset("naver-clova-ix/cord-v2")
-    except Exception:
+
+    if _read_done_marker(output_path) is not None:
+        print(f"Already downloaded, loading from {output_path}")
+        return load_from_disk(str(output_path))
+
+    for i, repo_id in enumerate(cfg["hf"]):
         try:
-            dataset = load_dataset("katanaml/cord")
-        except Exception:
-            dataset = load_dataset("Voxel51/consolidated_receipt_dataset")
-    
+            dataset = load_dataset(repo_id)
+            break
+        except Exception as e:
+            if i == len(cfg["hf"]) - 1:
+                raise
+            print(f"  {repo_id} failed ({e}), trying next source...")
+
     print(f"Splits: {list(dataset.keys())}")
     for split in dataset.keys():
         print(f"  {split}: {len(dataset[split])} examples")
-    
+
     # Save
     dataset.save_to_disk(str(output_path))
+    _write_done_marker(output_path)
     print(f"Saved to: {output_path}")
-    
+
     # Preview
     print("\nSample:")
     sample = dataset[list(dataset.keys())[0]][0]
     print(f"  Keys: {list(sample.keys())}")
-    
+
     return dataset
 
 
-def download_cuad():
+def download_docmatix(image_format="png", output_format="files", prefetch=DEFAULT_PREFETCH):
     """
-    Download CUAD dataset (contracts).
-    - 13,000+ labels in 510 commercial contracts
-    - 41 categories of important clauses
-    - Legal contract review
+    Download Docmatix dataset (subset).
+    - 2.4 million images, 9.5 million Q/A pairs
+    - 100x larger than DocVQA
+    - We download a subset for fine-tuning
+    - image_format: "png" or "jpeg", used only when images must be re-encoded
+    - output_format: "files" (images + JSONL), "webdataset" (tar shards) or "parquet"
+    - prefetch: streamed examples to buffer ahead on a background thread (0 disables)
     """
-    print("\n" + "=" * 60)
-    print("Downloading CUAD (Contract Dataset)...")
-    print("=" * 60)
-    
-    output_path = Path(OUTPUT_DIR) / "cuad"
+    _print_header("Downloading Docmatix (subset)...")
+
+    output_path = Path(OUTPUT_DIR) / "docmatix"
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    # Load from HuggingFace (script-free parquet version)
-    dataset = load_dataset("dvgodoy/CUAD_v1_Contract_Understanding_clause_classification")
 
-    print(f"Splits: {list(dataset.keys())}")
-    for split in dataset.keys():
-        print(f"  {split}: {len(dataset[split])} examples")
-    
-    # Save
-    dataset.save_to_disk(str(output_path))
-    print(f"Saved to: {output_path}")
-    
-    # Preview
-    print("\nSample:")
-    sample = dataset[list(dataset.keys())[0]][0]
-    print(f"  Keys: {list(sample.keys())}")
+    done = _read_done_marker(output_path)
+    if done and done.get("output_format") == output_format:
+        print(f"Already downloaded: {done.get('count', 0)} examples in {output_path}")
+        return done.get("count", 0)
 
-    return dataset
+    # Load subset (full dataset is huge): download parquet shards in parallel and
+    # stream them locally, stopping once we have enough examples
+    try:
+        shards = _list_parquet_shards("HuggingFaceM4/Docmatix", "images")
+    except Exception as e:
+        print(f"  Could not resolve parquet shards ({e}), falling back to Hub streaming")
+        shards = []
 
+    if shards:
+        dataset = _stream_parquet_shards("HuggingFaceM4/Docmatix", shards, ("images",))
+    else:
+        dataset = load_dataset(
+            "HuggingFaceM4/Docmatix",
+            "images",
+            split="train",
+            streaming=True
+        )
+        # Keep the original encoded image bytes rather than decoding to PIL
+        dataset = _disable_image_decoding(dataset, ("images",))
+
+    # Save incrementally to avoid OOM — images and metadata go straight to disk
+    max_examples = 50000
+    print(f"Downloading first {max_examples} examples (streaming to disk)...")
 
-def download_sroie():
+    with _open_sink(output_format, output_path, "docmatix_50k", output_path / "images", image_format) as sink:
+        count = _stream_and_persist(dataset, sink, ("images",), max_examples=max_examples, prefetch=prefetch)
+
+    _write_done_marker(output_path, count=count, output_format=output_format)
+    print(f"Downloaded: {count} examples")
+    print(f"Saved to: {sink}")
+
+    return count
+
+
+def download_sroie(image_format="png", output_format="files", prefetch=DEFAULT_PREFETCH):
     """
     Download SROIE dataset (scanned receipts).
     - 973 scanned receipts in English
     - OCR and information extraction
+    - image_format: "png" or "jpeg", used only when images must be re-encoded
+    - output_format: "files" (images + JSONL), "webdataset" (tar shards) or "parquet"
+    - prefetch: streamed examples to buffer ahead on a background thread (0 disables)
     """
-    print("\n" + "=" * 60)
-    print("Downloading SROIE (Scanned Receipts)...")
-    print("=" * 60)
-    
+    _print_header("Downloading SROIE (Scanned Receipts)...")
+
     output_path = Path(OUTPUT_DIR) / "sroie"
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    # darentang/sroie is small (~973 receipts), safe to load directly
-    # Only use streaming for the larger fallback dataset
+
+    done = _read_done_marker(output_path)
+    if done and done.get("output_format") == output_format:
+        print(f"Already downloaded: {done.get('count', 0)} examples in {output_path}")
+        return done.get("count", 0)
+
+    image_keys = ("image", "images")
     images_dir = output_path / "images"
-    images_dir.mkdir(parents=True, exist_ok=True)
 
-    dataset = None
+    # darentang/sroie is small (~973 receipts), safe to load directly
+    # Only use streaming for the larger fallback dataset
     try:
         print("Trying darentang/sroie...")
         dataset = load_dataset("darentang/sroie")
+        splits = {split: (dataset[split], None, 0) for split in dataset.keys()}
     except Exception as e:
         print(f"  Failed: {e}")
         print("Trying fallback: priyank-m/SROIE_2019_text_recognition (streaming, capped at 2000)...")
-
-    if dataset is not None:
-        # Direct load succeeded — save splits to disk
-        total_count = 0
-        for split in dataset.keys():
-            split_dir = images_dir / split
-            split_dir.mkdir(parents=True, exist_ok=True)
-            metadata_file = output_path / f"sroie_{split}.jsonl"
-
-            count = 0
-            with open(metadata_file, "w") as f:
-                for example in tqdm(dataset[split], desc=f"  {split}"):
-                    saved_images = []
-                    for key in ["image", "images"]:
-                        img = example.get(key)
-                        if img is None:
-                            continue
-                        imgs = img if isinstance(img, list) else [img]
-                        for img_idx, im in enumerate(imgs):
-                            img_path = split_dir / f"{count:06d}_{img_idx}.png"
-                            if hasattr(im, "save"):
-                                im.save(str(img_path))
-                                saved_images.append(str(img_path))
-
-                    meta = {k: v for k, v in example.items() if k not in ("image", "images")}
-                    meta["image_paths"] = saved_images
-                    meta["example_id"] = count
-                    f.write(json.dumps(meta) + "\n")
-                    count += 1
-
-            print(f"  {split}: {count} examples")
-            total_count += count
-    else:
         # Fallback: stream with a cap to avoid 30K+ slow download
-        max_examples = 2000
-        total_count = 0
+        splits = {}
         for split in ["train", "test"]:
             try:
-                stream = load_dataset(
-                    "priyank-m/SROIE_2019_text_recognition",
-                    split=split, streaming=True
+                splits[split] = (
+                    load_dataset("priyank-m/SROIE_2019_text_recognition", split=split, streaming=True),
+                    2000,
+                    prefetch,
                 )
             except Exception:
                 print(f"  Skipping split '{split}' (not found)")
-                continue
 
-            split_dir = images_dir / split
-            split_dir.mkdir(parents=True, exist_ok=True)
-            metadata_file = output_path / f"sroie_{split}.jsonl"
-
-            count = 0
-            with open(metadata_file, "w") as f:
-                for example in tqdm(stream, desc=f"  {split}", total=max_examples):
-                    if count >= max_examples:
-                        break
-                    saved_images = []
-                    for key in ["image", "images"]:
-                        img = example.get(key)
-                        if img is None:
-                            continue
-                        imgs = img if isinstance(img, list) else [img]
-                        for img_idx, im in enumerate(imgs):
-                            img_path = split_dir / f"{count:06d}_{img_idx}.png"
-                            if hasattr(im, "save"):
-                                im.save(str(img_path))
-                                saved_images.append(str(img_path))
-
-                    meta = {k: v for k, v in example.items() if k not in ("image", "images")}
-                    meta["image_paths"] = saved_images
-                    meta["example_id"] = count
-                    f.write(json.dumps(meta) + "\n")
-                    count += 1
-
-            print(f"  {split}: {count} examples")
-            total_count += count
+    total_count = 0
+    for split, (data, max_examples, split_prefetch) in splits.items():
+        data = _disable_image_decoding(data, image_keys)
+        with _open_sink(output_format, output_path, f"sroie_{split}", images_dir / split, image_format) as sink:
+            count = _stream_and_persist(data, sink, image_keys, max_examples=max_examples,
+                                        prefetch=split_prefetch, desc=f"  {split}")
+        print(f"  {split}: {count} examples")
+        total_count += count
 
+    _write_done_marker(output_path, count=total_count, output_format=output_format)
     print(f"Downloaded: {total_count} total examples")
-    print(f"Images saved to: {images_dir}")
     print(f"Saved to: {output_path}")
 
     return total_count
 
 
-def download_funsd():
-    """
-    Download FUNSD dataset (forms).
-    - Form understanding in noisy scanned documents
-    - Entity and relation labeling
-    """
-    print("\n" + "=" * 60)
-    print("Downloading FUNSD (Forms Dataset)...")
-    print("=" * 60)
-    
-    output_path = Path(OUTPUT_DIR) / "funsd"
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    # Load from HuggingFace
-    dataset = load_dataset("nielsr/funsd")
-    
-    print(f"Train: {len(dataset['train'])} examples")
-    print(f"Test: {len(dataset['test'])} examples")
-    
-    # Save
-    dataset.save_to_disk(str(output_path))
-    print(f"Saved to: {output_path}")
-    
-    return dataset
+# Datasets with a "download" entry need custom handling; the rest are plain
+# Hub datasets loaded with load_dataset() from the first working repo in "hf"
+# and saved with save_to_disk().
+DATASETS = [
+    {
+        # Mix of printed, typewritten, handwritten letters, memos, notes, reports
+        "id": "docvqa",
+        "name": "DocVQA",
+        "hf": ["HuggingFaceM4/DocumentVQA"],
+        "description": "Document Visual QA - general documents",
+        "size": "50K questions, 12K images",
+        "disk_gb": 5.0,
+        "use_for": "General document understanding",
+    },
+    {
+        "id": "docmatix",
+        "name": "Docmatix",
+        "download": download_docmatix,
+        "description": "Large-scale DocVQA dataset (50K subset)",
+        "size": "2.4M images, 9.5M Q&A pairs (downloading 50K subset)",
+        "disk_gb": 15.0,
+        "use_for": "Pre-training / large-scale fine-tuning",
+    },
+    {
+        # Indonesian receipts: 30 semantic classes (menu items, totals, subtotals)
+        "id": "cord",
+        "name": "CORD",
+        "hf": ["naver-clova-ix/cord-v2", "katanaml/cord", "Voxel51/consolidated_receipt_dataset"],
+        "description": "Receipt parsing dataset",
+        "size": "11K+ receipts",
+        "disk_gb": 1.5,
+        "use_for": "Invoice/Receipt extraction",
+    },
+    {
+        # Script-free parquet version; 41 categories of important clauses
+        "id": "cuad",
+        "name": "CUAD",
+        "hf": ["dvgodoy/CUAD_v1_Contract_Understanding_clause_classification"],
+        "description": "Contract Understanding dataset",
+        "size": "510 contracts, 13K labels, 41 clause types",
+        "disk_gb": 0.5,
+        "use_for": "Contract analysis",
+    },
+    {
+        "id": "sroie",
+        "name": "SROIE",
+        "download": download_sroie,
+        "description": "Scanned Receipts OCR",
+        "size": "973 receipts",
+        "disk_gb": 0.3,
+        "use_for": "Receipt OCR + extraction",
+    },
+    {
+        # Noisy scanned forms with entity and relation labels
+        "id": "funsd",
+        "name": "FUNSD",
+        "hf": ["nielsr/funsd"],
+        "description": "Form Understanding in Scanned Documents",
+        "size": "199 forms",
+        "disk_gb": 0.2,
+        "use_for": "Form field extraction",
+    },
+]
+DATASETS_BY_ID = {cfg["id"]: cfg for cfg in DATASETS}
 
 
 def show_dataset_summary():
@@ -336,66 +769,15 @@ def show_dataset_summary():
     print("\n" + "=" * 60)
     print("AVAILABLE DATASETS FOR DOCUMENT INTELLIGENCE")
     print("=" * 60)
-    
-    datasets_info = [
-        {
-            "name": "DocVQA",
-            "id": "docvqa",
-            "description": "Document Visual QA - general documents",
-            "size": "50K questions, 12K images",
-            "disk_gb": 5.0,
-            "use_for": "General document understanding"
-        },
-        {
-            "name": "Docmatix",
-            "id": "docmatix",
-            "description": "Large-scale DocVQA dataset (50K subset)",
-            "size": "2.4M images, 9.5M Q&A pairs (downloading 50K subset)",
-            "disk_gb": 15.0,
-            "use_for": "Pre-training / large-scale fine-tuning"
-        },
-        {
-            "name": "CORD",
-            "id": "cord",
-            "description": "Receipt parsing dataset",
-            "size": "11K+ receipts",
-            "disk_gb": 1.5,
-            "use_for": "Invoice/Receipt extraction"
-        },
-        {
-            "name": "CUAD",
-            "id": "cuad",
-            "description": "Contract Understanding dataset",
-            "size": "510 contracts, 13K labels, 41 clause types",
-            "disk_gb": 0.5,
-            "use_for": "Contract analysis"
-        },
-        {
-            "name": "SROIE",
-            "id": "sroie",
-            "description": "Scanned Receipts OCR",
-            "size": "973 receipts",
-            "disk_gb": 0.3,
-            "use_for": "Receipt OCR + extraction"
-        },
-        {
-            "name": "FUNSD",
-            "id": "funsd",
-            "description": "Form Understanding in Scanned Documents",
-            "size": "199 forms",
-            "disk_gb": 0.2,
-            "use_for": "Form field extraction"
-        },
-    ]
-    
-    for ds in datasets_info:
+
+    for ds in DATASETS:
         print(f"\n📄 {ds['name']} ({ds['id']})")
         print(f"   {ds['description']}")
         print(f"   Size: {ds['size']}")
         print(f"   Estimated disk space: ~{ds['disk_gb']} GB")
         print(f"   Use for: {ds['use_for']}")
 
-    total_gb = sum(ds["disk_gb"] for ds in datasets_info)
+    total_gb = sum(ds["disk_gb"] for ds in DATASETS)
     print(f"\nTotal estimated disk space (all datasets): ~{total_gb:.1f} GB")
 
     print("\n" + "-" * 60)
@@ -405,29 +787,25 @@ def show_dataset_summary():
     print("  python dataset.py --dataset cord cuad # Download multiple")
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Download datasets for document intelligence")
-    parser.add_argument("--all", action="store_true", help="Download all datasets")
-    parser.add_argument("--dataset", nargs="+", 
-                        choices=["docvqa", "docmatix", "cord", "cuad", "sroie", "funsd"],
-                        help="Specific dataset(s) to download")
-    parser.add_argument("--list", action="store_true", help="List available datasets")
-    
-    args = parser.parse_args()
-    
-    if args.list or (not args.all and not args.dataset):
-        show_dataset_summary()
-        return
-    
-    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-    
+def _run_one(dataset_name, download):
+    """Run one dataset download, returning an error message instead of raising."""
+    try:
+        download()
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def download_selected(args):
+    """Download the datasets selected on the command line. Returns True if every one succeeded."""
+    stream_options = {
+        "image_format": args.image_format,
+        "output_format": args.output_format,
+        "prefetch": args.prefetch,
+    }
     download_functions = {
-        "docvqa": download_docvqa,
-        "docmatix": download_docmatix,
-        "cord": download_cord,
-        "cuad": download_cuad,
-        "sroie": download_sroie,
-        "funsd": download_funsd,
+        cfg["id"]: partial(cfg["download"], **stream_options) if "download" in cfg else partial(_download_hf, cfg)
+        for cfg in DATASETS
     }
     
     if args.all:
@@ -436,10 +814,7 @@ def main():
         datasets_to_download = args.dataset
 
     # Estimate disk space needed
-    disk_estimates = {
-        "docvqa": 5.0, "docmatix": 15.0, "cord": 1.5,
-        "cuad": 0.5, "sroie": 0.3, "funsd": 0.2,
-    }
+    disk_estimates = {cfg["id"]: cfg["disk_gb"] for cfg in DATASETS}
     total_needed = sum(disk_estimates.get(d, 1.0) for d in datasets_to_download)
     free_gb = shutil.disk_usage(Path(OUTPUT_DIR).resolve()).free / (1024 ** 3)
 
@@ -455,24 +830,134 @@ def main():
 
     if total_needed > free_gb:
         print(f"\n⚠️  WARNING: Not enough disk space! Need ~{total_needed:.1f} GB but only {free_gb:.1f} GB available.")
-        return
-
-    confirm = input(f"\nProceed with download (~{total_needed:.1f} GB)? [y/N]: ").strip().lower()
-    if confirm != "y":
-        print("Download cancelled.")
-        return
+        return False
+
+    if not args.yes:
+        confirm = input(f"\nProceed with download (~{total_needed:.1f} GB)? [y/N]: ").strip().lower()
+        if confirm != "y":
+            print("Download cancelled.")
+            return False
+
+    if args.force:
+        for dataset_name in datasets_to_download:
+            marker = Path(OUTPUT_DIR) / dataset_name / DONE_MARKER
+            if marker.exists():
+                marker.unlink()
+
+    # Plain Hub datasets are latency-bound and independent of each other, so
+    # they download in separate processes (own `datasets` state and cache
+    # locks). The streaming datasets already run their own thread pools and
+    # stay in this process, overlapping with the pool.
+    streamed = [d for d in datasets_to_download if "download" in DATASETS_BY_ID[d]]
+    pooled = [d for d in datasets_to_download if d not in streamed]
+    jobs = min(args.jobs, len(pooled))
+
+    errors = {}
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {d: executor.submit(_run_one, d, download_functions[d]) for d in pooled}
+            for d in streamed:
+                errors[d] = _run_one(d, download_functions[d])
+            for d, future in futures.items():
+                errors[d] = future.result()
+    else:
+        for d in datasets_to_download:
+            errors[d] = _run_one(d, download_functions[d])
 
     for dataset_name in datasets_to_download:
-        try:
-            download_functions[dataset_name]()
-        except Exception as e:
-            print(f"\n❌ Error downloading {dataset_name}: {e}")
-            continue
+        if errors.get(dataset_name):
+            print(f"\n❌ Error downloading {dataset_name}: {errors[dataset_name]}")
     
     print("\n" + "=" * 60)
     print("DOWNLOAD COMPLETE")
     print("=" * 60)
     print(f"Datasets saved to: {OUTPUT_DIR}/")
+    return not any(errors.values())
+
+
+def _launch_run_id() -> str:
+    """An id shared by every rank of this launch: the Slurm job step, the torchrun run id, or the launcher's pid."""
+    if "SLURM_JOB_ID" in os.environ:
+        return f"slurm-{os.environ['SLURM_JOB_ID']}.{os.environ.get('SLURM_STEP_ID', '0')}"
+    run_id = os.environ.get("TORCHELASTIC_RUN_ID", "none")
+    if run_id != "none":
+        return f"torchrun-{run_id}"
+    # Ranks spawned by one torchrun agent (or one shell loop) share its pid
+    return f"ppid-{os.getppid()}"
+
+
+def _marker_run_id(marker: Path):
+    """Run id written into a rank-gating marker, or None if it doesn't exist yet."""
+    try:
+        return marker.read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_marker(marker: Path, run_id: str):
+    """Write `run_id` into `marker` atomically so waiters never read it half-written."""
+    tmp = marker.with_name(marker.name + ".tmp")
+    tmp.write_text(run_id)
+    os.replace(tmp, marker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download datasets for document intelligence")
+    parser.add_argument("--all", action="store_true", help="Download all datasets")
+    parser.add_argument("--dataset", nargs="+", 
+                        choices=[cfg["id"] for cfg in DATASETS],
+                        help="Specific dataset(s) to download")
+    parser.add_argument("--list", action="store_true", help="List available datasets")
+    parser.add_argument("--image-format", choices=["png", "jpeg"], default="png",
+                        help="Format for images that must be re-encoded (docmatix, sroie)")
+    parser.add_argument("--output-format", choices=["files", "webdataset", "parquet"], default="files",
+                        help="Write docmatix/sroie as image files + JSONL, WebDataset tar shards, "
+                             "or Parquet files with embedded images")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="Streamed examples to buffer ahead in the background (0 disables)")
+    parser.add_argument("--jobs", "-j", type=int, default=DEFAULT_JOBS,
+                        help="Hub datasets to download in parallel worker processes (1 = one at a time)")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-download datasets even if a completed copy exists")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="Skip the confirmation prompt (non-interactive / distributed runs)")
+    
+    args = parser.parse_args()
+    
+    if args.list or (not args.all and not args.dataset):
+        show_dataset_summary()
+        return
+    
+    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+
+    # Under torchrun/Slurm every rank on a node runs this script. Only local
+    # rank 0 downloads; the others wait for its sentinel instead of fetching
+    # and rewriting the same files. Both markers hold the launch's run id so
+    # one left over from an earlier run can't release or fail the waiters.
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    run_id = _launch_run_id()
+    sentinel = Path(OUTPUT_DIR) / ".done"
+    failed = Path(OUTPUT_DIR) / ".failed"
+    if local_rank != 0:
+        print(f"Local rank {local_rank}: waiting for rank 0 to finish downloading...")
+        while True:
+            if _marker_run_id(sentinel) == run_id:
+                return
+            if _marker_run_id(failed) == run_id:
+                print(f"Local rank {local_rank}: rank 0 failed to download the datasets")
+                sys.exit(1)
+            time.sleep(1)
+
+    for marker in (sentinel, failed):
+        if marker.exists():
+            marker.unlink()
+    ok = False
+    try:
+        ok = download_selected(args)
+    finally:
+        _write_marker(sentinel if ok else failed, run_id)
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
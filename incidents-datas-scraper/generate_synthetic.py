@@ -7,14 +7,33 @@ Estimated cost: ~$0.80 for 1,500 examples (vs $2.50 without batching)
 """
 
 import anthropic
+import array
+import asyncio
+import hashlib
+import httpx
 import json
+import mmap
 import random
 import time
 import re
+import sys
 from pathlib import Path
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
+from typing import NamedTuple
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # Load environment variables
 load_dotenv()
 
@@ -23,22 +42,53 @@ load_dotenv()
 # =============================================================================
 
 OUTPUT_DIR = "data/synthetic"
-OUTPUT_FILE = f"{OUTPUT_DIR}/synthetic_incidents.json"
+OUTPUT_FILE = f"{OUTPUT_DIR}/synthetic_incidents.jsonl"  # append-only, one example per line; also the resume checkpoint
+META_FILE = f"{OUTPUT_DIR}/synthetic_incidents.meta.json"
+RESPONSE_CACHE_FILE = f"{OUTPUT_DIR}/response_cache.jsonl"
+WRITE_BUFFER_SIZE = 1 << 20
 TARGET_EXAMPLES = 1500
 MODEL = "claude-3-5-haiku-20241022"
 
 # Batch size - generate multiple responses per API call
 BATCH_SIZE = 5
+TEMPLATES_PER_REQUEST = 3  # incidents packed into one call; past ~5 the longer calls outweigh the savings
+# Output budget scales with the responses requested; fits the prompt's 300-word
+# cap once JSON-escaped (TEMPLATES_PER_REQUEST * BATCH_SIZE of these stays under
+# the model's 8192-token output limit)
+MAX_TOKENS_PER_RESPONSE = 500
 
 # Rate limiting
 REQUESTS_PER_MINUTE = 50
-DELAY_BETWEEN_REQUESTS = 60 / REQUESTS_PER_MINUTE
+TOKENS_PER_MINUTE = 100_000  # input + output tokens, estimated per request from the prompt and max_tokens
+MAX_CONCURRENT_REQUESTS = REQUESTS_PER_MINUTE // 2  # in-flight live requests
+CHECKPOINT_EVERY = 50  # examples between checkpoint saves
+
+# Message Batches API (--batch-api): half price, no per-minute rate limit
+BATCH_API_MIN_COUNT = 100  # Live runs at least this big suggest --batch-api
+MAX_BATCH_REQUESTS = 10_000  # API limit per submitted batch
+BATCH_POLL_INTERVAL = 30  # seconds between status checks
+BATCH_SPARE_JOBS = 0.1  # extra jobs submitted per batch round to cover off-format and failed responses
+MAX_RETRIES = 5
+LOW_REMAINING_REQUESTS = 5  # Start spreading requests out below this many left in the window
+MAX_BACKOFF = 30
+
+# Templates whose error text is this similar (Jaccard over shingles) are generated once
+DUPLICATE_THRESHOLD = 0.85
+SHINGLE_SIZE = 5
 
 # =============================================================================
 # INCIDENT TEMPLATES BY TECHNOLOGY
 # =============================================================================
 
-INCIDENT_TEMPLATES = {
+class IncidentTemplate(NamedTuple):
+    """One incident to generate responses for; hints are the causes responses should vary over."""
+    scenario: str
+    error: str
+    category: str
+    hints: tuple
+
+
+_TEMPLATE_DATA = {
     "kubernetes": [
         {
             "scenario": "Pod CrashLoopBackOff",
@@ -603,6 +653,85 @@ Current shard group duration: 1d requires retention >= 1d""",
     ],
 }
 
+_SHARED = {}
+
+
+def _flyweight(value):
+    """The first equal value seen during the catalog build, so duplicates share one object."""
+    return _SHARED.setdefault(value, value)
+
+
+# Frozen once at import: a read-only tech -> tuple of records. Categories and
+# hint phrases repeat across techs; interning them makes the catalog's copies
+# the canonical ones, so strings read back from a checkpoint compare with `is`.
+# Equal hint tuples and error bodies are pooled the same way.
+INCIDENT_TEMPLATES = MappingProxyType({
+    tech: tuple(
+        IncidentTemplate(
+            t["scenario"],
+            _flyweight(t["error"]),
+            sys.intern(t["category"]),
+            _flyweight(tuple(sys.intern(hint) for hint in t["hints"]))
+        )
+        for t in templates
+    )
+    for tech, templates in _TEMPLATE_DATA.items()
+})
+del _TEMPLATE_DATA, _SHARED, _flyweight
+
+# Every (tech, template) pair; template ids are indexes into this tuple
+ALL_TEMPLATES = tuple((tech, template) for tech, templates in INCIDENT_TEMPLATES.items() for template in templates)
+
+# Hint phrase (lowercased) -> ids of the templates listing it
+_HINT_TEMPLATES = {}
+for _tid, (_, _template) in enumerate(ALL_TEMPLATES):
+    for _hint in _template.hints:
+        _HINT_TEMPLATES.setdefault(_hint.lower(), []).append(_tid)
+del _tid, _template, _hint
+
+
+@lru_cache(maxsize=None)
+def _hint_finder():
+    """
+    Build the one-pass hint matcher on first use rather than at import, since
+    generation runs never need it: an Aho-Corasick automaton when pyahocorasick
+    is installed, otherwise a single alternation that finds where phrases
+    start. Either way, every phrase occurring in the text is found, including
+    ones nested in or overlapping a longer phrase. Returns a function from
+    lowercased text to the set of phrases found.
+    """
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for hint in _HINT_TEMPLATES:
+            automaton.add_word(hint, hint)
+        automaton.make_automaton()
+        return lambda text: {hint for _, hint in automaton.iter(text)}
+    
+    # The lookahead only reports one alternative per position, so it is used to
+    # find where phrases start; every phrase sharing that first character is
+    # then checked there
+    pattern = re.compile("(?=" + "|".join(map(re.escape, _HINT_TEMPLATES)) + ")")
+    by_first_char = {}
+    for hint in _HINT_TEMPLATES:
+        by_first_char.setdefault(hint[0], []).append(hint)
+    return lambda text: {
+        hint
+        for match in pattern.finditer(text)
+        for hint in by_first_char[text[match.start()]]
+        if text.startswith(hint, match.start())
+    }
+
+
+@lru_cache(maxsize=256)
+def match_hints(text: str) -> frozenset:
+    """
+    Ids (into ALL_TEMPLATES) of the templates whose hint phrases occur in `text`.
+    Memoized, since the same error text tends to be matched repeatedly.
+    """
+    found = _hint_finder()(text.lower())
+    return frozenset(tid for hint in found for tid in _HINT_TEMPLATES[hint])
+
+
 # =============================================================================
 # SYSTEM PROMPT FOR CONSISTENT FORMAT
 # =============================================================================
@@ -617,43 +746,31 @@ Your response should include:
 
 Be direct, specific, and actionable. Reference exact commands, config changes, or code fixes when applicable."""
 
-# =============================================================================
-# BATCH GENERATION
-# =============================================================================
-
-def generate_batch_responses(
-    client: anthropic.Anthropic, 
-    tech: str, 
-    scenario: str, 
-    error: str, 
-    hints: list,
-    batch_size: int = BATCH_SIZE
-) -> list:
-    """Generate multiple incident responses in a single API call."""
-    
-    prompt = f"""You are a senior DevOps/SRE engineer. Generate {batch_size} DIFFERENT expert responses for this {tech} incident.
+# Identical in every example, so all of them share this one dict
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
 
-**Scenario:** {scenario}
-
-**Error/Logs:**
-```
-{error}
-```
+# User turn stored with every example (one per template, shared by its responses)
+USER_PROMPT_TEMPLATE = "Analyze this {tech} incident and provide diagnosis and fix:\n\n```\n{error}\n```"
 
-**Possible causes to consider (use different ones for variety):** {', '.join(hints)}
+# Generation instructions are identical for every request, so they go in the
+# system prompt marked for prompt caching; only the incident varies per request.
+# (Haiku only caches prefixes of 2048+ tokens, so this pays off once the
+# instructions grow or a larger model is used.)
+GENERATION_INSTRUCTIONS = """You are a senior DevOps/SRE engineer. For each incident you are given, generate the requested number of DIFFERENT expert responses.
 
-Generate {batch_size} different responses. Each response should:
+Each response should:
 - Focus on a DIFFERENT root cause from the hints
 - Have different specific commands/fixes
 - Follow this EXACT format
 
-Return ONLY a JSON array with {batch_size} objects, each containing a "response" field.
+Return ONLY a JSON array with one object per response, each containing the "incident" number it answers and a "response" field.
 
 Example format:
 ```json
 [
-  {{"response": "**Root Cause:** [cause 1]\\n\\n**Severity:** High\\n\\n**Immediate Fix:**\\n1. [step]\\n2. [step]\\n\\n**Prevention:** [tip]"}},
-  {{"response": "**Root Cause:** [cause 2]\\n\\n**Severity:** Medium\\n\\n**Immediate Fix:**\\n1. [step]\\n2. [step]\\n\\n**Prevention:** [tip]"}}
+  {"incident": 1, "response": "**Root Cause:** [cause 1]\\n\\n**Severity:** High\\n\\n**Immediate Fix:**\\n1. [step]\\n2. [step]\\n\\n**Prevention:** [tip]"},
+  {"incident": 1, "response": "**Root Cause:** [cause 2]\\n\\n**Severity:** Medium\\n\\n**Immediate Fix:**\\n1. [step]\\n2. [step]\\n\\n**Prevention:** [tip]"},
+  {"incident": 2, "response": "**Root Cause:** [cause 1]\\n\\n**Severity:** Critical\\n\\n**Immediate Fix:**\\n1. [step]\\n2. [step]\\n\\n**Prevention:** [tip]"}
 ]
 ```
 
@@ -661,45 +778,647 @@ Requirements:
 - Each response must be UNIQUE with different root cause
 - Include exact commands where applicable
 - Keep each response concise but complete (150-300 words)
-- Return ONLY valid JSON array, no other text"""
+- Return ONLY the valid JSON array, no other text, then the line END"""
+
+GENERATION_SYSTEM_BLOCKS = [{"type": "text", "text": GENERATION_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}]
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+# The array is complete by the time END is written; cuts off any trailing chatter
+STOP_SEQUENCES = ["\nEND"]
+
+# Per-request part of the generation prompt: TEMPLATES_PER_REQUEST numbered incidents
+BATCH_PROMPT_TEMPLATE = """Generate {batch_size} DIFFERENT expert responses for each of these {count} incidents.
+
+{incidents}"""
+
+INCIDENT_PROMPT_TEMPLATE = """### Incident {number}: {tech}
+
+**Scenario:** {scenario}
+
+**Error/Logs:**
+```
+{error}
+```
 
+**Possible causes to consider (use different ones for variety):** {hints}"""
+
+# Compiled once; applied to every reply and every response in it
+_JSON_ARRAY_RE = re.compile(r"\[[\s\S]*\]")
+_RESP_RE = re.compile(
+    r"\*\*Root Cause:\*\*\s*(?P<root>.+?)\n\s*"
+    r"\*\*Severity:\*\*\s*(?P<sev>Low|Medium|High|Critical)\s*\n\s*"
+    r"\*\*Immediate Fix:\*\*\s*(?P<fix>.+?)\n\s*"
+    r"\*\*Prevention:\*\*\s*(?P<prev>.+)$",
+    re.S,
+)
+
+# =============================================================================
+# BATCH GENERATION
+# =============================================================================
+
+def _dumps(obj, indent: bool = False) -> bytes:
+    """Serialize `obj` to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _loads(data):
+    """Parse JSON text or bytes, using orjson when it is installed."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def build_batch_prompt(jobs: list, batch_size: int = BATCH_SIZE) -> str:
+    """Build the prompt asking for `batch_size` different responses to each job's incident, numbered from 1."""
+    incidents = "\n\n".join(
+        INCIDENT_PROMPT_TEMPLATE.format_map({
+            "number": number,
+            "tech": job.tech,
+            "scenario": job.template.scenario,
+            "error": job.template.error,
+            "hints": ", ".join(job.template.hints),
+        })
+        for number, job in enumerate(jobs, 1)
+    )
+    return BATCH_PROMPT_TEMPLATE.format_map({"batch_size": batch_size, "count": len(jobs), "incidents": incidents})
+
+
+def parse_response(text: str):
+    """Split one response into its root/sev/fix/prev sections, or None if it is off-format."""
+    match = _RESP_RE.search(text)
+    return match.groupdict() if match else None
+
+
+def parse_batch_responses(response_text: str, count: int = 1, batch_size: int = BATCH_SIZE) -> list:
+    """
+    Extract the well-formed "response" strings from the model's JSON array
+    reply, as one list per incident (`count` lists, in incident order, at most
+    `batch_size` each). A response without an "incident" number only counts
+    when there is a single incident to attribute it to.
+    """
+    results = [[] for _ in range(count)]
+    json_match = _JSON_ARRAY_RE.search(response_text)
+    if not json_match:
+        print(f"    Warning: Could not parse JSON from response")
+        return results
+    
     try:
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=2500,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        responses = _loads(json_match.group())
+    except ValueError as e:  # Raised by both json and orjson
+        print(f"    JSON parse error: {e}")
+        return results
+    
+    skipped = 0
+    for r in responses:
+        if not isinstance(r, dict) or not isinstance(r.get("response"), str):
+            continue
+        number = r.get("incident", 1 if count == 1 else None)
+        if not isinstance(number, int) or not 1 <= number <= count or not parse_response(r["response"]):
+            skipped += 1
+            continue
+        if len(results[number - 1]) < batch_size:
+            results[number - 1].append(r["response"])
+    if skipped:
+        print(f"    Skipped {skipped} off-format response(s)")
+    return results
+
+
+def _reply_text(message) -> str:
+    """The text of a generation reply, warning when it was cut off at max_tokens."""
+    if message.stop_reason == "max_tokens":
+        print(f"    Warning: reply truncated at max_tokens, its JSON array is likely incomplete")
+    if not message.content:
+        print(f"    Warning: empty reply (stop_reason={message.stop_reason})")
+        return ""
+    return message.content[0].text
+
+
+def _ratelimit_delay(headers) -> float:
+    """
+    Seconds to hold off before the next request, from the rate-limit headers:
+    nothing while plenty of requests remain, otherwise the time left until the
+    window resets spread over the requests still allowed in it.
+    """
+    try:
+        remaining = int(headers.get("anthropic-ratelimit-requests-remaining"))
+        reset = datetime.fromisoformat(headers.get("anthropic-ratelimit-requests-reset").replace("Z", "+00:00"))
+    except (TypeError, ValueError, AttributeError):
+        return 0.0
+    if remaining >= LOW_REMAINING_REQUESTS:
+        return 0.0
+    return max(0.0, reset.timestamp() - time.time()) / max(remaining, 1)
+
+
+def _retry_after(error: anthropic.RateLimitError):
+    """The Retry-After seconds sent with a 429, if any."""
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+async def generate_batch_responses(
+    client: anthropic.AsyncAnthropic, 
+    jobs: list,
+    batch_size: int = BATCH_SIZE,
+    limiter: "RateLimiter" = None
+) -> list:
+    """
+    Generate responses for several incidents in a single API call; returns
+    one list of responses per job ([] for every job if the call failed).
+    429s are retried after Retry-After (or exponential backoff with jitter),
+    connection errors and 5xx/overloaded responses after backoff, and low
+    remaining-request headers slow down every caller sharing `limiter`.
+    """
+    prompt = build_batch_prompt(jobs, batch_size)
+    max_tokens = MAX_TOKENS_PER_RESPONSE * batch_size * len(jobs)
+    estimated_tokens = len(prompt) // 4 + max_tokens
+    
+    for attempt in range(MAX_RETRIES):
+        if limiter is not None:
+            await limiter.wait(estimated_tokens)
+        try:
+            raw = await client.messages.with_raw_response.create(
+                model=MODEL,
+                max_tokens=max_tokens,
+                stop_sequences=STOP_SEQUENCES,
+                system=GENERATION_SYSTEM_BLOCKS,
+                messages=[{"role": "user", "content": prompt}],
+                extra_headers=PROMPT_CACHING_HEADERS
+            )
+        except anthropic.RateLimitError as e:
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(MAX_BACKOFF, 2 ** attempt + random.random())
+            print(f"    Rate limited, retrying in {delay:.1f}s...")
+            if limiter is not None:
+                limiter.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+        except (anthropic.APIConnectionError, anthropic.InternalServerError) as e:
+            delay = min(MAX_BACKOFF, 2 ** attempt + random.random())
+            print(f"    API error ({e}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+        except anthropic.APIError as e:
+            print(f"    API error: {e}")
+            return [[] for _ in jobs]
+        
+        delay = _ratelimit_delay(raw.headers)
+        if delay and limiter is not None:
+            limiter.pause(delay)
+        return parse_batch_responses(_reply_text(raw.parse()), len(jobs), batch_size)
+    
+    print(f"    Giving up after {MAX_RETRIES} attempts")
+    return [[] for _ in jobs]
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled at `rate` per second; only callers that find it short wait."""
+    
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+    
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (a request larger than the bucket waits for a full one)."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return max(0.0, min(amount, self.capacity) - self._tokens) / self.rate
+    
+    def take(self, amount: float):
+        self._tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, so requests go out at
+    full speed while quota remains, plus a shared pause the API can impose
+    through its headers.
+    """
+    
+    def __init__(self, requests_per_minute: int = REQUESTS_PER_MINUTE, tokens_per_minute: int = TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Hold back every caller for at least `seconds` from now."""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+    
+    async def wait(self, tokens: int = 0):
+        """Sleep until a request of about `tokens` tokens fits both budgets; callers go in turn."""
+        async with self._lock:
+            while True:
+                delay = max(self._resume_at - time.monotonic(), self.requests.delay(1), self.tokens.delay(tokens))
+                if delay <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    return
+                await asyncio.sleep(delay)
+
+
+class ResponseCache:
+    """
+    Generated responses keyed by a hash of the job inputs, persisted as an
+    append-only JSONL log so reruns (including --fresh ones) never pay for the
+    same job twice. The batch number is part of the key, so the repeated
+    batches of one template stay distinct generations.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_FILE):
+        self.path = Path(path)
+        self._responses = {}
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = _loads(line)
+                    except ValueError:
+                        continue  # Partial line from an interrupted run
+                    self._responses[entry["key"]] = entry["responses"]
+        self._log = open(self.path, "ab")
+
+    def __len__(self):
+        return len(self._responses)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._responses
+
+    @staticmethod
+    def key(tech: str, template: IncidentTemplate, batch_num: int) -> str:
+        return hashlib.sha1(f"{MODEL}|{tech}|{template.scenario}|{batch_num}|{template.error}".encode()).hexdigest()
+
+    def get(self, key: str) -> list:
+        return self._responses[key]
+
+    def put(self, key: str, responses: list):
+        """Store a job's responses and append them to the log (failed jobs are not cached)."""
+        if not responses:
+            return
+        self._responses[key] = responses
+        self._log.write(_dumps({"key": key, "responses": responses}) + b"\n")
+        # Flush each entry so a crash or Ctrl-C doesn't lose responses already paid for
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
+
+
+# =============================================================================
+# MESSAGE BATCHES API
+# =============================================================================
+
+def _with_retries(call, *args, **kwargs):
+    """Run a Message Batches API call, backing off on transient API errors."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return call(*args, **kwargs)
+        except anthropic.APIError as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = _retry_after(e) if isinstance(e, anthropic.RateLimitError) else None
+            if delay is None:
+                delay = 2 ** attempt
+            print(f"    API error ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+
+def run_message_batches(client: anthropic.Anthropic, groups: list) -> list:
+    """
+    Submit each group of jobs as one request through the Message Batches API.
+    Returns, per group, the parsed responses for each of its jobs ([] if the request failed).
+    """
+    results = [[[] for _ in group] for group in groups]
+    
+    for start in range(0, len(groups), MAX_BATCH_REQUESTS):
+        chunk = groups[start:start + MAX_BATCH_REQUESTS]
+        requests = [
+            {
+                "custom_id": str(start + offset),
+                "params": {
+                    "model": MODEL,
+                    "max_tokens": MAX_TOKENS_PER_RESPONSE * BATCH_SIZE * len(group),
+                    "stop_sequences": STOP_SEQUENCES,
+                    "system": GENERATION_SYSTEM_BLOCKS,
+                    "messages": [{
+                        "role": "user",
+                        "content": build_batch_prompt(group, BATCH_SIZE)
+                    }]
+                }
+            }
+            for offset, group in enumerate(chunk)
+        ]
         
-        response_text = response.content[0].text.strip()
+        batch = _with_retries(client.messages.batches.create, requests=requests)
+        print(f"  Submitted batch {batch.id} ({len(requests)} requests)")
         
-        # Extract JSON from response
-        json_match = re.search(r'\[[\s\S]*\]', response_text)
-        if json_match:
-            json_str = json_match.group()
-            responses = json.loads(json_str)
-            return [r.get("response", "") for r in responses if r.get("response")]
-        else:
-            print(f"    Warning: Could not parse JSON from response")
-            return []
-            
-    except json.JSONDecodeError as e:
-        print(f"    JSON parse error: {e}")
-        return []
-    except Exception as e:
-        print(f"    API error: {e}")
-        return []
+        while batch.processing_status != "ended":
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = _with_retries(client.messages.batches.retrieve, batch.id)
+        
+        failed = 0
+        for entry in _with_retries(client.messages.batches.results, batch.id):
+            if entry.result.type != "succeeded":
+                failed += 1
+                continue
+            index = int(entry.custom_id)
+            results[index] = parse_batch_responses(_reply_text(entry.result.message), len(groups[index]), BATCH_SIZE)
+        
+        print(f"  Batch {batch.id} ended ({failed} failed requests)")
+    
+    return results
+
+
+def format_example(tech: str, template: IncidentTemplate, batch_num: int, user_content: str, response: str) -> dict:
+    """Format one generated response as a training example."""
+    return {
+        "messages": [
+            _SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": user_content
+            },
+            {
+                "role": "assistant",
+                "content": response
+            }
+        ],
+        "_meta": {
+            "source": "synthetic",
+            "tech": tech,
+            "scenario": template.scenario,
+            "category": template.category,
+            "batch": batch_num
+        }
+    }
+
+
+_DIGITS_RE = re.compile(r"\d+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _shingles(text: str) -> frozenset:
+    """Character shingles of an error, with numbers (ports, PIDs, sizes) and spacing normalized."""
+    text = _SPACE_RE.sub(" ", _DIGITS_RE.sub("0", text.lower()))
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1)))
+
+
+def find_duplicate_templates(threshold: float = DUPLICATE_THRESHOLD) -> dict:
+    """
+    Map each near-duplicate template, as (tech, scenario), to the earlier one it
+    repeats, so the same incident isn't paid for twice under different techs.
+    The catalog is small enough to compare every pair directly.
+    """
+    seen = []
+    duplicates = {}
+    for tech, templates in INCIDENT_TEMPLATES.items():
+        for template in templates:
+            shingles = _shingles(template.error)
+            key = (tech, template.scenario)
+            for other_key, other in seen:
+                if len(shingles & other) >= threshold * len(shingles | other):
+                    duplicates[key] = other_key
+                    break
+            else:
+                seen.append((key, shingles))
+    return duplicates
+
+
+class Job(NamedTuple):
+    """One template's share of a packed request (TEMPLATES_PER_REQUEST jobs per call): BATCH_SIZE responses."""
+    tech: str
+    template: IncidentTemplate
+    batch_num: int
+
+
+def plan_jobs(target_count: int) -> list:
+    """
+    Every job needed for `target_count` examples, as one flat list in a fixed
+    shuffled order, so a run that stops at the target still covers every
+    technology and a resumed run walks the same sequence. Each technology gets
+    an equal share of the target, split over its own templates. One spare
+    batch per template follows the plan, used only to make up for responses
+    that came back empty or off-format.
+    """
+    duplicates = find_duplicate_templates()
+    for (tech, scenario), (other_tech, other_scenario) in duplicates.items():
+        print(f"  Skipping {tech}/{scenario}: near-duplicate of {other_tech}/{other_scenario}")
+    
+    templates_by_tech = {
+        tech: [template for template in templates if (tech, template.scenario) not in duplicates]
+        for tech, templates in INCIDENT_TEMPLATES.items()
+    }
+    # Batches per template for each technology, computed once and rounded up
+    # so every technology can reach its share; the run stops at the target
+    tech_target = target_count // len(templates_by_tech)
+    plan = {
+        tech: max(-(-tech_target // (max(len(templates), 1) * BATCH_SIZE)), 1)
+        for tech, templates in templates_by_tech.items()
+    }
+    jobs = [
+        Job(tech, template, batch_num)
+        for tech, templates in templates_by_tech.items()
+        for template in templates
+        for batch_num in range(plan[tech])
+    ]
+    spare = [
+        Job(tech, template, plan[tech])
+        for tech, templates in templates_by_tech.items()
+        for template in templates
+    ]
+    rng = random.Random(42)
+    rng.shuffle(jobs)
+    rng.shuffle(spare)
+    return jobs + spare
+
+
+def add_examples(examples: list, stats: dict, job: Job, responses: list, target_count: int, checkpoint):
+    """Append the usable responses from one job to the run and the checkpoint, stopping at the target."""
+    tech, template, batch_num = job
+    user_content = USER_PROMPT_TEMPLATE.format_map({"tech": tech, "error": template.error})
+    for response in responses:
+        if stats["total"] >= target_count:
+            break
+        if not response or len(response) < 100:
+            continue
+        example = format_example(tech, template, batch_num, user_content, response)
+        examples.append(example)
+        checkpoint.write(_dumps(example) + b"\n")
+        stats["total"] += 1
+        stats["by_tech"][tech] += 1
+
+
+def generate_with_message_batches(client: anthropic.Anthropic, jobs: list, examples: list, stats: dict, target_count: int, checkpoint, cache):
+    """
+    Generate the remaining examples through the Message Batches API instead of
+    live calls. Each round submits the jobs the shortfall needs plus
+    BATCH_SPARE_JOBS spare, since off-format responses and failed requests
+    come back empty; another round tops up anything still missing.
+    """
+    while stats["total"] < target_count and jobs:
+        needed = -(-(target_count - stats["total"]) // BATCH_SIZE)
+        needed += max(1, int(needed * BATCH_SPARE_JOBS))
+        round_jobs, jobs = jobs[:needed], jobs[needed:]
+        before = stats["total"]
+        _run_batch_round(client, round_jobs, examples, stats, target_count, checkpoint, cache)
+        if stats["total"] == before:
+            print("  Batch round added no examples, stopping")
+            break
+        if stats["total"] < target_count and jobs:
+            print(f"  {target_count - stats['total']} examples short, submitting a top-up batch")
+
+
+def _run_batch_round(client: anthropic.Anthropic, jobs: list, examples: list, stats: dict, target_count: int, checkpoint, cache):
+    """Submit `jobs` as one round of message batches and add their responses to the run."""
+    if cache is None:
+        groups = [jobs[i:i + TEMPLATES_PER_REQUEST] for i in range(0, len(jobs), TEMPLATES_PER_REQUEST)]
+        for group, results in zip(groups, run_message_batches(client, groups)):
+            for job, responses in zip(group, results):
+                add_examples(examples, stats, job, responses, target_count, checkpoint)
+        return
+    
+    # Only jobs missing from the cache are submitted; then every job is read from it
+    keys = [cache.key(*job) for job in jobs]
+    missing = [(job, key) for job, key in zip(jobs, keys) if key not in cache]
+    groups = [missing[i:i + TEMPLATES_PER_REQUEST] for i in range(0, len(missing), TEMPLATES_PER_REQUEST)]
+    if groups:
+        results = run_message_batches(client, [[job for job, _ in group] for group in groups])
+        for group, group_results in zip(groups, results):
+            for (_, key), responses in zip(group, group_results):
+                cache.put(key, responses)
+    
+    for job, key in zip(jobs, keys):
+        if key in cache:
+            add_examples(examples, stats, job, cache.get(key), target_count, checkpoint)
+
+
+def make_async_client() -> anthropic.AsyncAnthropic:
+    """
+    An async client whose connection pool keeps one warm keep-alive socket per
+    concurrent request. The SDK's own retries are off, since
+    generate_batch_responses already retries transient errors itself.
+    """
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+        keepalive_expiry=30.0
+    )
+    return anthropic.AsyncAnthropic(max_retries=0, http_client=anthropic.DefaultAsyncHttpxClient(limits=limits))
+
+
+async def generate_concurrently(client: anthropic.AsyncAnthropic, jobs: list, examples: list, stats: dict, target_count: int, checkpoint, cache):
+    """
+    Generate the remaining examples with concurrent live calls on one event loop.
+    Each call covers up to TEMPLATES_PER_REQUEST uncached jobs. At most
+    MAX_CONCURRENT_REQUESTS calls are in flight, and only while their jobs
+    could still be needed to reach the target; results are checkpointed as
+    each call completes.
+    """
+    jobs = iter(jobs)
+    limiter = RateLimiter()
+    last_checkpoint = stats["total"]
+    
+    def run_request(group):
+        return asyncio.ensure_future(generate_batch_responses(client, [job for job, _ in group], BATCH_SIZE, limiter))
+    
+    pending = {}
+    in_flight = 0  # Jobs covered by the pending calls
+    while True:
+        # Keep MAX_CONCURRENT_REQUESTS in flight, but don't ask for more than the target needs
+        while len(pending) < MAX_CONCURRENT_REQUESTS:
+            group = []
+            while len(group) < TEMPLATES_PER_REQUEST and stats["total"] + (in_flight + len(group)) * BATCH_SIZE < target_count:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                key = cache.key(*job) if cache is not None else None
+                if key is not None and key in cache:
+                    add_examples(examples, stats, job, cache.get(key), target_count, checkpoint)
+                    continue
+                group.append((job, key))
+            if not group:
+                break
+            pending[run_request(group)] = group
+            in_flight += len(group)
+        if not pending:
+            break
+        
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            group = pending.pop(task)
+            in_flight -= len(group)
+            for (job, key), responses in zip(group, task.result()):
+                if cache is not None:
+                    cache.put(key, responses)
+                add_examples(examples, stats, job, responses, target_count, checkpoint)
+        
+        if stats["total"] - last_checkpoint >= CHECKPOINT_EVERY:
+            last_checkpoint = stats["total"]
+            print(f"  Generated {stats['total']}/{target_count}...")
+            save_checkpoint(checkpoint)
 
 
-def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES):
-    """Generate synthetic incident response training data using batched generation."""
+def load_checkpoint(path: str = OUTPUT_FILE):
+    """
+    Read an existing JSONL checkpoint and return its examples, the
+    (tech, scenario, batch) jobs it already covers, and its stats. A partial
+    last line from an interrupted run is truncated so new examples append cleanly.
+    """
+    examples = []
+    done = set()
+    stats = {"total": 0, "by_tech": {tech: 0 for tech in INCIDENT_TEMPLATES}}
+    if not Path(path).exists():
+        return examples, done, stats
     
-    client = anthropic.Anthropic()
+    complete = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            example = _loads(line)
+            # Share the repeated strings and system message, as freshly made examples do
+            example["messages"][0] = _SYSTEM_MESSAGE
+            meta = example["_meta"]
+            for field in ("source", "tech", "category"):
+                if field in meta:
+                    meta[field] = sys.intern(meta[field])
+            examples.append(example)
+            done.add((meta["tech"], meta["scenario"], meta.get("batch")))
+            stats["total"] += 1
+            stats["by_tech"][meta["tech"]] = stats["by_tech"].get(meta["tech"], 0) + 1
+    
+    if complete != Path(path).stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(complete)
+    return examples, done, stats
+
+
+def generate_synthetic_dataset(
+    target_count: int = TARGET_EXAMPLES,
+    use_batch_api: bool = False,
+    fresh: bool = False,
+    use_cache: bool = True
+):
+    """
+    Generate synthetic incident response training data using batched generation.
+    With `use_batch_api`, requests go through the Message Batches API (half
+    price, no per-minute limits, but results can take up to 24 hours) instead
+    of live calls.
+    """
     
     Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
     
-    # Count total templates
+    # Count total templates and plan the calls once, up front
     total_templates = sum(len(templates) for templates in INCIDENT_TEMPLATES.values())
-    batches_per_template = max((target_count // total_templates) // BATCH_SIZE, 1)
+    jobs = plan_jobs(target_count)
     
     print("=" * 60)
     print("SYNTHETIC INCIDENT DATA GENERATOR (BATCHED)")
@@ -708,80 +1427,50 @@ def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES):
     print(f"Technologies: {len(INCIDENT_TEMPLATES)}")
     print(f"Total templates: {total_templates}")
     print(f"Batch size: {BATCH_SIZE}")
-    print(f"Batches per template: {batches_per_template}")
-    print(f"Estimated API calls: ~{total_templates * batches_per_template}")
+    print(f"Templates per request: {TEMPLATES_PER_REQUEST}")
+    print(f"Batches per template: ~{len(jobs) // total_templates - 1} (+1 spare)")
+    print(f"Estimated API calls: ~{-(-target_count // (BATCH_SIZE * TEMPLATES_PER_REQUEST))}")
     print(f"Model: {MODEL}")
     print()
     
-    examples = []
-    stats = {"total": 0, "by_tech": {}}
+    # Resume from the checkpoint unless asked to start over
+    if fresh and Path(OUTPUT_FILE).exists():
+        Path(OUTPUT_FILE).unlink()
+    examples, done, stats = load_checkpoint()
+    if stats["total"]:
+        print(f"Resuming: {stats['total']} examples already in {OUTPUT_FILE}")
+    jobs = [job for job in jobs if (job.tech, job.template.scenario, job.batch_num) not in done]
     
-    for tech, templates in INCIDENT_TEMPLATES.items():
-        print(f"\n[{tech.upper()}]")
-        stats["by_tech"][tech] = 0
-        
-        for template in templates:
-            if stats["total"] >= target_count:
-                break
-            
-            for batch_num in range(batches_per_template):
-                if stats["total"] >= target_count:
-                    break
-                
-                responses = generate_batch_responses(
-                    client,
-                    tech,
-                    template["scenario"],
-                    template["error"],
-                    template.get("hints", []),
-                    BATCH_SIZE
-                )
-                
-                for response in responses:
-                    if stats["total"] >= target_count:
-                        break
-                    
-                    if not response or len(response) < 100:
-                        continue
-                    
-                    # Format as training example
-                    example = {
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": SYSTEM_PROMPT
-                            },
-                            {
-                                "role": "user",
-                                "content": f"Analyze this {tech} incident and provide diagnosis and fix:\n\n```\n{template['error']}\n```"
-                            },
-                            {
-                                "role": "assistant",
-                                "content": response
-                            }
-                        ],
-                        "_meta": {
-                            "source": "synthetic",
-                            "tech": tech,
-                            "scenario": template["scenario"],
-                            "category": template["category"]
-                        }
-                    }
-                    
-                    examples.append(example)
-                    stats["total"] += 1
-                    stats["by_tech"][tech] += 1
-                
-                time.sleep(DELAY_BETWEEN_REQUESTS)
-            
-            if stats["total"] % 50 == 0 and stats["total"] > 0:
-                print(f"  Generated {stats['total']}/{target_count}...")
-                save_checkpoint(examples, stats)
-        
-        print(f"  {tech}: {stats['by_tech'][tech]} examples")
+    if use_batch_api:
+        print("Mode: Message Batches API (results can take up to 24 hours)")
+        print("  Ctrl-C stops waiting but not the batch; cancel it in the Console by its batch ID.")
+        print("  Rerun the same command to resume; examples already saved are kept.")
+    else:
+        print(f"Mode: live calls, {MAX_CONCURRENT_REQUESTS} concurrent")
+        if target_count - stats["total"] >= BATCH_API_MIN_COUNT:
+            print("  Tip: --batch-api halves the cost if you can wait up to 24 hours for results")
     
-    # Final save
-    save_checkpoint(examples, stats, final=True)
+    cache = ResponseCache() if use_cache else None
+    if cache is not None:
+        print(f"Cached responses: {len(cache)}")
+    
+    try:
+        with open(OUTPUT_FILE, "ab", buffering=WRITE_BUFFER_SIZE) as checkpoint:
+            # Uses ANTHROPIC_API_KEY env var
+            if use_batch_api:
+                generate_with_message_batches(anthropic.Anthropic(max_retries=0), jobs, examples, stats, target_count, checkpoint, cache)
+            else:
+                asyncio.run(generate_concurrently(make_async_client(), jobs, examples, stats, target_count, checkpoint, cache))
+    finally:
+        if cache is not None:
+            cache.close()
+    
+    return finish_generation(examples, stats)
+
+
+def finish_generation(examples: list, stats: dict):
+    """Write the run metadata and print a summary."""
+    save_meta(stats)
     
     print("\n" + "=" * 60)
     print("GENERATION COMPLETE")
@@ -790,22 +1479,41 @@ def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES):
     print(f"\nBy technology:")
     for tech, count in sorted(stats["by_tech"].items(), key=lambda x: -x[1]):
         print(f"  {tech}: {count}")
-    print(f"\nSaved to: {OUTPUT_FILE}")
+    print(f"\nSaved to: {OUTPUT_FILE} (metadata: {META_FILE})")
     
     return examples, stats
 
 
-def save_checkpoint(examples: list, stats: dict, final: bool = False):
-    """Save checkpoint of generated examples."""
-    output = {
+def save_checkpoint(checkpoint):
+    """Push buffered checkpoint lines to disk; examples are appended as they are made."""
+    checkpoint.flush()
+
+
+def save_meta(stats: dict):
+    """Write the small metadata file next to the examples, which are already on disk as JSONL."""
+    meta = {
         "generated_at": datetime.now().isoformat(),
         "model": MODEL,
         "stats": stats,
-        "examples": examples
+        "examples_file": OUTPUT_FILE
     }
     
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(output, f, indent=2)
+    Path(META_FILE).write_bytes(_dumps(meta, indent=True))
+
+
+def _line_spans(mm) -> list:
+    """(start, end) byte span of every non-empty line in a mapped JSONL file."""
+    spans = []
+    start = 0
+    size = len(mm)
+    while start < size:
+        end = mm.find(b"\n", start)
+        if end == -1:
+            end = size
+        if mm[start:end].strip():
+            spans.append((start, end))
+        start = end + 1
+    return spans
 
 
 def merge_with_training_data(
@@ -813,42 +1521,43 @@ def merge_with_training_data(
     train_file: str = "data/processed/train.jsonl",
     output_file: str = "data/processed/train_with_synthetic.jsonl"
 ):
-    """Merge synthetic data with existing training data."""
+    """
+    Merge synthetic data with existing training data.
+    The training file is memory-mapped and only its line offsets are held;
+    lines from both files are copied across in shuffled order as raw bytes.
+    """
     
     print("\nMerging synthetic data with training data...")
     
-    # Load synthetic
-    with open(synthetic_file) as f:
-        synthetic_data = json.load(f)
-    synthetic_examples = synthetic_data["examples"]
-    print(f"Synthetic examples: {len(synthetic_examples)}")
-    
-    # Load existing training data
-    existing = []
-    with open(train_file) as f:
-        for line in f:
-            existing.append(json.loads(line))
-    print(f"Existing examples: {len(existing)}")
-    
-    # Combine and shuffle
-    combined = existing + synthetic_examples
-    random.seed(42)
-    random.shuffle(combined)
+    # Synthetic lines are few; keep them as bytes
+    with open(synthetic_file, "rb") as f:
+        synthetic_lines = [line.rstrip(b"\n") for line in f if line.strip()]
+    print(f"Synthetic examples: {len(synthetic_lines)}")
     
-    # Save
-    with open(output_file, "w") as f:
-        for ex in combined:
-            f.write(json.dumps(ex) + "\n")
+    tech_counts = {}
+    with open(train_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        spans = _line_spans(mm)
+        print(f"Existing examples: {len(spans)}")
+        
+        # Shuffle packed indices over both sources in place: below len(spans) is a training line
+        order = array.array("L", range(len(spans) + len(synthetic_lines)))
+        random.Random(42).shuffle(order)
+        
+        with open(output_file, "wb") as out:
+            for k in order:
+                if k < len(spans):
+                    start, end = spans[k]
+                    line = mm[start:end]
+                else:
+                    line = synthetic_lines[k - len(spans)]
+                out.write(line + b"\n")
+                # Only lines that mention a tech are worth parsing for the stats
+                tech = _loads(line).get("_meta", {}).get("tech", "unknown") if b'"tech"' in line else "unknown"
+                tech_counts[tech] = tech_counts.get(tech, 0) + 1
     
-    print(f"Combined total: {len(combined)}")
+    print(f"Combined total: {len(order)}")
     print(f"Saved to: {output_file}")
     
-    # Tech distribution
-    tech_counts = {}
-    for ex in combined:
-        tech = ex.get("_meta", {}).get("tech", "unknown")
-        tech_counts[tech] = tech_counts.get(tech, 0) + 1
-    
     print(f"\nFinal distribution by tech:")
     for tech, count in sorted(tech_counts.items(), key=lambda x: -x[1]):
         print(f"  {tech}: {count}")
@@ -862,12 +1571,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate synthetic incident data")
     parser.add_argument("--count", type=int, default=TARGET_EXAMPLES, help="Number of examples")
     parser.add_argument("--merge-only", action="store_true", help="Only merge existing synthetic data")
+    parser.add_argument("--batch-api", action="store_true", help="Use the Message Batches API (50%% cheaper, results within 24h)")
+    parser.add_argument("--fresh", action="store_true", help="Discard the checkpoint and start over")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the response cache")
     
     args = parser.parse_args()
     
     if args.merge_only:
         merge_with_training_data()
     else:
-        generate_synthetic_dataset(args.count)
+        generate_synthetic_dataset(args.count, use_batch_api=args.batch_api, fresh=args.fresh, use_cache=not args.no_cache)
         print("\nTo merge with training data, run:")
         print("  python generate_synthetic.py --merge-only")
@@ -29,6 +29,10 @@ HEADERS = {
 }
 
 GRAPHQL_URL = "https://api.github.com/graphql"
+
+# One session for every query, so paginated requests reuse the same keep-alive connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
 OUTPUT_DIR = "data/github_discussions"
 
 # Date filter
@@ -65,7 +69,7 @@ def run_graphql_query(query: str, variables: dict = None) -> dict:
     if variables:
         payload["variables"] = variables
     
-    response = requests.post(GRAPHQL_URL, headers=HEADERS, json=payload)
+    response = SESSION.post(GRAPHQL_URL, json=payload)
     
     if response.status_code != 200:
         print(f"GraphQL error: {response.status_code}")
@@ -6,13 +6,30 @@ Estimated cost: ~$1.50 for 1,500 examples
 """
 
 import anthropic
+import ast
+import asyncio
+import hashlib
+import io
 import json
+import queue
 import random
+import re
+import shutil
+import statistics
+import threading
 import time
+import tokenize
+from collections import defaultdict
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import NamedTuple, Tuple
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # =============================================================================
@@ -21,360 +38,403 @@ load_dotenv()
 
 OUTPUT_DIR = "data/synthetic"
 OUTPUT_FILE = f"{OUTPUT_DIR}/synthetic_examples.json"
+CHECKPOINT_FILE = f"{OUTPUT_DIR}/synthetic_examples.jsonl"
+REVIEW_CACHE_FILE = f"{OUTPUT_DIR}/review_cache.jsonl"
+TOKEN_BUDGET_FILE = f"{OUTPUT_DIR}/max_tokens.json"
 TARGET_EXAMPLES = 1500
 MODEL = "claude-3-5-haiku-latest"
 
-# Rate limiting
-REQUESTS_PER_MINUTE = 50
-DELAY_BETWEEN_REQUESTS = 60 / REQUESTS_PER_MINUTE  # 1.2 seconds
+# Rate limiting: the SDK retries 429/5xx with exponential backoff and jitter;
+# request starts are only spaced out once the anthropic-ratelimit-* headers
+# report fewer than RATE_LIMIT_HEADROOM requests left in the current window
+MAX_RETRIES = 5
+RATE_LIMIT_HEADROOM = 5
+
+# Requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Snippets reviewed per API request; each request returns a JSON array of reviews
+REVIEW_BATCH_SIZE = 8
+MAX_TOKENS_PER_REVIEW = 200
+
+# After this many reviews, max_tokens is cut to 1.2x the p99 observed length
+AUTOTUNE_SAMPLE = 100
+AUTOTUNE_HEADROOM = 1.2
+
+
+def _dumps(obj, indent: bool = False) -> bytes:
+    """Serialize `obj` to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2).encode()
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _loads(data):
+    """Parse JSON text or bytes, using orjson when it is installed."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 
 # =============================================================================
 # BUG TEMPLATES
 # =============================================================================
 
-BUG_TEMPLATES = [
+class Template(NamedTuple):
+    code: str
+    bug: str
+    vars: Tuple[str, ...]
+
+
+class BugCategory(NamedTuple):
+    category: str
+    description: str
+    templates: Tuple[Template, ...]
+
+
+BUG_TEMPLATES = (
     # 1. Null/None access
-    {
-        "category": "null_access",
-        "description": "Accessing attribute on potentially None value",
-        "templates": [
-            {
-                "code": '''def get_user_email(user_id):
+    BugCategory(
+        category="null_access",
+        description="Accessing attribute on potentially None value",
+        templates=(
+            Template(
+                code='''def get_user_email(user_id):
     user = db.query(User).filter_by(id=user_id).first()
     return user.email''',
-                "bug": "No null check before accessing .email",
-                "vars": ["user", "email", "User", "user_id"]
-            },
-            {
-                "code": '''def get_order_total(order_id):
+                bug="No null check before accessing .email",
+                vars=("user", "email", "User", "user_id")
+            ),
+            Template(
+                code='''def get_order_total(order_id):
     order = Order.objects.filter(id=order_id).first()
     return order.total_amount''',
-                "bug": "No null check before accessing .total_amount",
-                "vars": ["order", "total_amount", "Order", "order_id"]
-            },
-            {
-                "code": '''def get_config_value(key):
+                bug="No null check before accessing .total_amount",
+                vars=("order", "total_amount", "Order", "order_id")
+            ),
+            Template(
+                code='''def get_config_value(key):
     config = load_config().get(key)
     return config.value''',
-                "bug": "No null check - .get() can return None",
-                "vars": ["config", "value", "key"]
-            },
-        ]
-    },
+                bug="No null check - .get() can return None",
+                vars=("config", "value", "key")
+            ),
+        ),
+    ),
     # 2. Missing error handling
-    {
-        "category": "missing_error_handling",
-        "description": "No try/except around operations that can fail",
-        "templates": [
-            {
-                "code": '''def read_json_file(filepath):
+    BugCategory(
+        category="missing_error_handling",
+        description="No try/except around operations that can fail",
+        templates=(
+            Template(
+                code='''def read_json_file(filepath):
     with open(filepath) as f:
         return json.load(f)''',
-                "bug": "No handling for FileNotFoundError or JSONDecodeError",
-                "vars": ["filepath", "json"]
-            },
-            {
-                "code": '''def fetch_api_data(url):
+                bug="No handling for FileNotFoundError or JSONDecodeError",
+                vars=("filepath", "json")
+            ),
+            Template(
+                code='''def fetch_api_data(url):
     response = requests.get(url)
     return response.json()''',
-                "bug": "No handling for network errors or invalid JSON",
-                "vars": ["url", "requests", "response"]
-            },
-            {
-                "code": '''def parse_int(value):
+                bug="No handling for network errors or invalid JSON",
+                vars=("url", "requests", "response")
+            ),
+            Template(
+                code='''def parse_int(value):
     return int(value)''',
-                "bug": "No handling for ValueError if value isn't numeric",
-                "vars": ["value", "int"]
-            },
-        ]
-    },
+                bug="No handling for ValueError if value isn't numeric",
+                vars=("value", "int")
+            ),
+        ),
+    ),
     # 3. Resource leaks
-    {
-        "category": "resource_leak",
-        "description": "Resource not properly closed",
-        "templates": [
-            {
-                "code": '''def read_file(path):
+    BugCategory(
+        category="resource_leak",
+        description="Resource not properly closed",
+        templates=(
+            Template(
+                code='''def read_file(path):
     f = open(path, 'r')
     content = f.read()
     return content''',
-                "bug": "File handle never closed - should use 'with' statement",
-                "vars": ["path", "f", "content"]
-            },
-            {
-                "code": '''def query_database(query):
+                bug="File handle never closed - should use 'with' statement",
+                vars=("path", "f", "content")
+            ),
+            Template(
+                code='''def query_database(query):
     conn = psycopg2.connect(DATABASE_URL)
     cursor = conn.cursor()
     cursor.execute(query)
     return cursor.fetchall()''',
-                "bug": "Database connection never closed",
-                "vars": ["query", "conn", "cursor"]
-            },
-            {
-                "code": '''def download_file(url, dest):
+                bug="Database connection never closed",
+                vars=("query", "conn", "cursor")
+            ),
+            Template(
+                code='''def download_file(url, dest):
     response = urllib.request.urlopen(url)
     data = response.read()
     with open(dest, 'wb') as f:
         f.write(data)''',
-                "bug": "URL connection not closed if error occurs during write",
-                "vars": ["url", "dest", "response"]
-            },
-        ]
-    },
+                bug="URL connection not closed if error occurs during write",
+                vars=("url", "dest", "response")
+            ),
+        ),
+    ),
     # 4. Index/Key errors
-    {
-        "category": "index_error",
-        "description": "Accessing index/key that may not exist",
-        "templates": [
-            {
-                "code": '''def get_first_item(items):
+    BugCategory(
+        category="index_error",
+        description="Accessing index/key that may not exist",
+        templates=(
+            Template(
+                code='''def get_first_item(items):
     return items[0]''',
-                "bug": "No check if list is empty - IndexError risk",
-                "vars": ["items"]
-            },
-            {
-                "code": '''def get_nested_value(data):
+                bug="No check if list is empty - IndexError risk",
+                vars=("items",)
+            ),
+            Template(
+                code='''def get_nested_value(data):
     return data["config"]["database"]["host"]''',
-                "bug": "No check if nested keys exist - KeyError risk",
-                "vars": ["data", "config", "database", "host"]
-            },
-            {
-                "code": '''def get_last_element(results):
+                bug="No check if nested keys exist - KeyError risk",
+                vars=("data", "config", "database", "host")
+            ),
+            Template(
+                code='''def get_last_element(results):
     return results[-1]''',
-                "bug": "No check if list is empty before accessing last element",
-                "vars": ["results"]
-            },
-        ]
-    },
+                bug="No check if list is empty before accessing last element",
+                vars=("results",)
+            ),
+        ),
+    ),
     # 5. Type errors
-    {
-        "category": "type_error",
-        "description": "Type mismatch or wrong type handling",
-        "templates": [
-            {
-                "code": '''def calculate_average(numbers):
+    BugCategory(
+        category="type_error",
+        description="Type mismatch or wrong type handling",
+        templates=(
+            Template(
+                code='''def calculate_average(numbers):
     return sum(numbers) / len(numbers)''',
-                "bug": "ZeroDivisionError if numbers is empty",
-                "vars": ["numbers"]
-            },
-            {
-                "code": '''def concat_strings(a, b):
+                bug="ZeroDivisionError if numbers is empty",
+                vars=("numbers",)
+            ),
+            Template(
+                code='''def concat_strings(a, b):
     return a + b''',
-                "bug": "No type validation - will fail if non-strings passed",
-                "vars": ["a", "b"]
-            },
-            {
-                "code": '''def format_price(price):
+                bug="No type validation - will fail if non-strings passed",
+                vars=("a", "b")
+            ),
+            Template(
+                code='''def format_price(price):
     return f"${price:.2f}"''',
-                "bug": "Will fail if price is None or non-numeric",
-                "vars": ["price"]
-            },
-        ]
-    },
+                bug="Will fail if price is None or non-numeric",
+                vars=("price",)
+            ),
+        ),
+    ),
     # 6. Logic errors
-    {
-        "category": "logic_error",
-        "description": "Off-by-one or incorrect logic",
-        "templates": [
-            {
-                "code": '''def is_valid_age(age):
+    BugCategory(
+        category="logic_error",
+        description="Off-by-one or incorrect logic",
+        templates=(
+            Template(
+                code='''def is_valid_age(age):
     return age > 0 and age < 120''',
-                "bug": "Should be >= and <= for boundary inclusivity, also no type check",
-                "vars": ["age"]
-            },
-            {
-                "code": '''def get_items_in_range(items, start, end):
+                bug="Should be >= and <= for boundary inclusivity, also no type check",
+                vars=("age",)
+            ),
+            Template(
+                code='''def get_items_in_range(items, start, end):
     return items[start:end-1]''',
-                "bug": "Off-by-one error - end-1 excludes the intended last item",
-                "vars": ["items", "start", "end"]
-            },
-            {
-                "code": '''def is_leap_year(year):
+                bug="Off-by-one error - end-1 excludes the intended last item",
+                vars=("items", "start", "end")
+            ),
+            Template(
+                code='''def is_leap_year(year):
     return year % 4 == 0''',
-                "bug": "Incomplete leap year logic - missing century exception",
-                "vars": ["year"]
-            },
-        ]
-    },
+                bug="Incomplete leap year logic - missing century exception",
+                vars=("year",)
+            ),
+        ),
+    ),
     # 7. Security issues
-    {
-        "category": "security",
-        "description": "Security vulnerabilities",
-        "templates": [
-            {
-                "code": '''def get_user_by_name(name):
+    BugCategory(
+        category="security",
+        description="Security vulnerabilities",
+        templates=(
+            Template(
+                code='''def get_user_by_name(name):
     query = f"SELECT * FROM users WHERE name = '{name}'"
     return db.execute(query)''',
-                "bug": "SQL injection vulnerability - use parameterized queries",
-                "vars": ["name", "query", "users"]
-            },
-            {
-                "code": '''def run_command(user_input):
+                bug="SQL injection vulnerability - use parameterized queries",
+                vars=("name", "query", "users")
+            ),
+            Template(
+                code='''def run_command(user_input):
     import os
     os.system(f"echo {user_input}")''',
-                "bug": "Command injection vulnerability - user input in shell command",
-                "vars": ["user_input", "os"]
-            },
-            {
-                "code": '''API_KEY = "sk-1234567890abcdef"
+                bug="Command injection vulnerability - user input in shell command",
+                vars=("user_input", "os")
+            ),
+            Template(
+                code='''API_KEY = "sk-1234567890abcdef"
 
 def call_api():
     return requests.get(URL, headers={"Authorization": API_KEY})''',
-                "bug": "Hardcoded API key - should use environment variables",
-                "vars": ["API_KEY", "URL"]
-            },
-        ]
-    },
+                bug="Hardcoded API key - should use environment variables",
+                vars=("API_KEY", "URL")
+            ),
+        ),
+    ),
     # 8. Concurrency issues
-    {
-        "category": "concurrency",
-        "description": "Race conditions and thread safety",
-        "templates": [
-            {
-                "code": '''counter = 0
+    BugCategory(
+        category="concurrency",
+        description="Race conditions and thread safety",
+        templates=(
+            Template(
+                code='''counter = 0
 
 def increment():
     global counter
     counter += 1''',
-                "bug": "Race condition - counter increment is not atomic",
-                "vars": ["counter"]
-            },
-            {
-                "code": '''cache = {}
+                bug="Race condition - counter increment is not atomic",
+                vars=("counter",)
+            ),
+            Template(
+                code='''cache = {}
 
 def get_or_compute(key, func):
     if key not in cache:
         cache[key] = func()
     return cache[key]''',
-                "bug": "Race condition - check-then-act pattern is not thread-safe",
-                "vars": ["cache", "key", "func"]
-            },
-        ]
-    },
+                bug="Race condition - check-then-act pattern is not thread-safe",
+                vars=("cache", "key", "func")
+            ),
+        ),
+    ),
     # 9. Memory/Performance issues
-    {
-        "category": "performance",
-        "description": "Memory leaks or inefficient code",
-        "templates": [
-            {
-                "code": '''def read_large_file(path):
+    BugCategory(
+        category="performance",
+        description="Memory leaks or inefficient code",
+        templates=(
+            Template(
+                code='''def read_large_file(path):
     with open(path) as f:
         return f.read()''',
-                "bug": "Reads entire file into memory - use iteration for large files",
-                "vars": ["path", "f"]
-            },
-            {
-                "code": '''def find_duplicates(items):
+                bug="Reads entire file into memory - use iteration for large files",
+                vars=("path", "f")
+            ),
+            Template(
+                code='''def find_duplicates(items):
     duplicates = []
     for i, item in enumerate(items):
         if item in items[i+1:]:
             duplicates.append(item)
     return duplicates''',
-                "bug": "O(n²) complexity - use a set for O(n) duplicate detection",
-                "vars": ["items", "duplicates"]
-            },
-            {
-                "code": '''def build_string(items):
+                bug="O(n²) complexity - use a set for O(n) duplicate detection",
+                vars=("items", "duplicates")
+            ),
+            Template(
+                code='''def build_string(items):
     result = ""
     for item in items:
         result += str(item) + ","
     return result''',
-                "bug": "String concatenation in loop is O(n²) - use join()",
-                "vars": ["items", "result"]
-            },
-        ]
-    },
+                bug="String concatenation in loop is O(n²) - use join()",
+                vars=("items", "result")
+            ),
+        ),
+    ),
     # 10. API misuse
-    {
-        "category": "api_misuse",
-        "description": "Incorrect use of standard library or frameworks",
-        "templates": [
-            {
-                "code": '''def parse_date(date_str):
+    BugCategory(
+        category="api_misuse",
+        description="Incorrect use of standard library or frameworks",
+        templates=(
+            Template(
+                code='''def parse_date(date_str):
     return datetime.strptime(date_str, "%Y-%m-%d")''',
-                "bug": "No error handling for invalid date format",
-                "vars": ["date_str", "datetime"]
-            },
-            {
-                "code": '''async def fetch_all(urls):
+                bug="No error handling for invalid date format",
+                vars=("date_str", "datetime")
+            ),
+            Template(
+                code='''async def fetch_all(urls):
     results = []
     for url in urls:
         results.append(await fetch(url))
     return results''',
-                "bug": "Sequential awaits - use asyncio.gather() for parallel execution",
-                "vars": ["urls", "results", "fetch"]
-            },
-            {
-                "code": '''def update_dict(d, key, value):
+                bug="Sequential awaits - use asyncio.gather() for parallel execution",
+                vars=("urls", "results", "fetch")
+            ),
+            Template(
+                code='''def update_dict(d, key, value):
     d[key] = value
     return d''',
-                "bug": "Mutates input dict and returns it - confusing API, pick one pattern",
-                "vars": ["d", "key", "value"]
-            },
-        ]
-    },
+                bug="Mutates input dict and returns it - confusing API, pick one pattern",
+                vars=("d", "key", "value")
+            ),
+        ),
+    ),
     # 11. Boolean/Comparison errors  
-    {
-        "category": "comparison_error",
-        "description": "Incorrect boolean logic or comparisons",
-        "templates": [
-            {
-                "code": '''def is_empty(value):
+    BugCategory(
+        category="comparison_error",
+        description="Incorrect boolean logic or comparisons",
+        templates=(
+            Template(
+                code='''def is_empty(value):
     if value == None or value == "":
         return True
     return False''',
-                "bug": "Use 'is None' not '== None', also consider using 'not value'",
-                "vars": ["value"]
-            },
-            {
-                "code": '''def check_range(x, low, high):
+                bug="Use 'is None' not '== None', also consider using 'not value'",
+                vars=("value",)
+            ),
+            Template(
+                code='''def check_range(x, low, high):
     return low < x < high''',
-                "bug": "May want inclusive bounds (<=) depending on use case, unclear API",
-                "vars": ["x", "low", "high"]
-            },
-            {
-                "code": '''def is_valid(items):
+                bug="May want inclusive bounds (<=) depending on use case, unclear API",
+                vars=("x", "low", "high")
+            ),
+            Template(
+                code='''def is_valid(items):
     return items != None and len(items) > 0''',
-                "bug": "Use 'is not None', could simplify to 'return bool(items)'",
-                "vars": ["items"]
-            },
-        ]
-    },
+                bug="Use 'is not None', could simplify to 'return bool(items)'",
+                vars=("items",)
+            ),
+        ),
+    ),
     # 12. Mutable default arguments
-    {
-        "category": "mutable_default",
-        "description": "Mutable default argument pitfall",
-        "templates": [
-            {
-                "code": '''def add_item(item, items=[]):
+    BugCategory(
+        category="mutable_default",
+        description="Mutable default argument pitfall",
+        templates=(
+            Template(
+                code='''def add_item(item, items=[]):
     items.append(item)
     return items''',
-                "bug": "Mutable default argument - list persists between calls",
-                "vars": ["item", "items"]
-            },
-            {
-                "code": '''def create_user(name, roles=[], metadata={}):
+                bug="Mutable default argument - list persists between calls",
+                vars=("item", "items")
+            ),
+            Template(
+                code='''def create_user(name, roles=[], metadata={}):
     return {"name": name, "roles": roles, "metadata": metadata}''',
-                "bug": "Mutable default arguments - use None and create inside function",
-                "vars": ["name", "roles", "metadata"]
-            },
-        ]
-    },
+                bug="Mutable default arguments - use None and create inside function",
+                vars=("name", "roles", "metadata")
+            ),
+        ),
+    ),
     # 13. Import/Dependency issues
-    {
-        "category": "import_issues",
-        "description": "Import problems or circular dependencies",
-        "templates": [
-            {
-                "code": '''from module import *
+    BugCategory(
+        category="import_issues",
+        description="Import problems or circular dependencies",
+        templates=(
+            Template(
+                code='''from module import *
 
 def process():
     return helper_function()''',
-                "bug": "Wildcard import - unclear which names are imported, pollution risk",
-                "vars": ["module", "helper_function"]
-            },
-            {
-                "code": '''import pandas as pd
+                bug="Wildcard import - unclear which names are imported, pollution risk",
+                vars=("module", "helper_function")
+            ),
+            Template(
+                code='''import pandas as pd
 import numpy as np
 import requests
 import json
@@ -382,84 +442,107 @@ import os
 
 def get_value():
     return json.loads("{}")''',
-                "bug": "Unused imports (pandas, numpy, requests, os) - remove them",
-                "vars": ["pandas", "numpy", "requests", "os"]
-            },
-        ]
-    },
+                bug="Unused imports (pandas, numpy, requests, os) - remove them",
+                vars=("pandas", "numpy", "requests", "os")
+            ),
+        ),
+    ),
     # 14. Exception handling anti-patterns
-    {
-        "category": "exception_antipattern",
-        "description": "Poor exception handling practices",
-        "templates": [
-            {
-                "code": '''def safe_divide(a, b):
+    BugCategory(
+        category="exception_antipattern",
+        description="Poor exception handling practices",
+        templates=(
+            Template(
+                code='''def safe_divide(a, b):
     try:
         return a / b
     except:
         return 0''',
-                "bug": "Bare except catches everything including KeyboardInterrupt - too broad",
-                "vars": ["a", "b"]
-            },
-            {
-                "code": '''def process_data(data):
+                bug="Bare except catches everything including KeyboardInterrupt - too broad",
+                vars=("a", "b")
+            ),
+            Template(
+                code='''def process_data(data):
     try:
         result = transform(data)
         save(result)
         notify()
     except Exception as e:
         pass''',
-                "bug": "Silently swallowing exceptions - at minimum log the error",
-                "vars": ["data", "result"]
-            },
-            {
-                "code": '''def load_config():
+                bug="Silently swallowing exceptions - at minimum log the error",
+                vars=("data", "result")
+            ),
+            Template(
+                code='''def load_config():
     try:
         return json.load(open("config.json"))
     except Exception as e:
         raise Exception("Config error")''',
-                "bug": "Losing original exception context - use 'raise ... from e'",
-                "vars": ["json", "config"]
-            },
-        ]
-    },
+                bug="Losing original exception context - use 'raise ... from e'",
+                vars=("json", "config")
+            ),
+        ),
+    ),
     # 15. Return value issues
-    {
-        "category": "return_issues",
-        "description": "Inconsistent or missing return values",
-        "templates": [
-            {
-                "code": '''def find_item(items, target):
+    BugCategory(
+        category="return_issues",
+        description="Inconsistent or missing return values",
+        templates=(
+            Template(
+                code='''def find_item(items, target):
     for item in items:
         if item == target:
             return item''',
-                "bug": "Implicit None return if not found - make it explicit",
-                "vars": ["items", "target", "item"]
-            },
-            {
-                "code": '''def validate(data):
+                bug="Implicit None return if not found - make it explicit",
+                vars=("items", "target", "item")
+            ),
+            Template(
+                code='''def validate(data):
     if not data:
         return False
     if "id" not in data:
         return
     return True''',
-                "bug": "Inconsistent returns - None vs False vs True",
-                "vars": ["data"]
-            },
-            {
-                "code": '''def get_status(code):
+                bug="Inconsistent returns - None vs False vs True",
+                vars=("data",)
+            ),
+            Template(
+                code='''def get_status(code):
     if code == 200:
         return "OK"
     elif code == 404:
         return "Not Found"
     elif code == 500:
         return "Error"''',
-                "bug": "No default return for unknown codes - returns None implicitly",
-                "vars": ["code"]
-            },
-        ]
-    },
-]
+                bug="No default return for unknown codes - returns None implicitly",
+                vars=("code",)
+            ),
+        ),
+    ),
+)
+
+
+def _flatten_templates(bug_templates: tuple) -> tuple:
+    """
+    Flatten the nested category -> templates list into parallel, index-aligned
+    lists (one entry per template) plus the index range of each category.
+    """
+    categories, descriptions, codes, bugs, template_vars = [], [], [], [], []
+    index_by_category = {}
+    for category_data in bug_templates:
+        start = len(codes)
+        for template in category_data.templates:
+            categories.append(category_data.category)
+            descriptions.append(category_data.description)
+            codes.append(template.code)
+            bugs.append(template.bug)
+            template_vars.append(template.vars)
+        index_by_category[category_data.category] = range(start, len(codes))
+    return categories, descriptions, codes, bugs, template_vars, index_by_category
+
+
+# BUG_TEMPLATES stays the hand-written source; the generator works on this flat view
+CATEGORIES, DESCRIPTIONS, CODES, BUGS, VARS, TEMPLATE_INDEX_BY_CATEGORY = _flatten_templates(BUG_TEMPLATES)
 
 # =============================================================================
 # VARIATION GENERATORS
@@ -484,21 +567,133 @@ ENTITY_NAMES = [
 ]
 
 
-def generate_variation(template: dict) -> dict:
-    """Generate a variation of a code template."""
-    code = template["code"]
+def _identifiers(tree: ast.AST) -> set:
+    """Every identifier appearing in the snippet, to avoid renaming onto one."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.Attribute):
+            names.add(node.attr)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split(".")[0])
+    return names
+
+
+def _bound_names(tree: ast.AST) -> set:
+    """Names the snippet binds itself (arguments, assignment targets), which are safe to rename."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+    return names
+
+
+def _rename_identifiers(tokens: tuple, renames: dict) -> str:
+    """Apply `renames` to identifier tokens, leaving attributes, strings and layout untouched."""
+    renamed = []
+    prev = None
+    for tok in tokens:
+        if tok.type == tokenize.NAME and tok.string in renames and not (prev and prev.string == "."):
+            tok = tok._replace(string=renames[tok.string])
+        if tok.type not in (tokenize.NL, tokenize.COMMENT):
+            prev = tok
+        renamed.append(tok)
+    return tokenize.untokenize(renamed)
+
+
+_ENTITY_NAME_SET = frozenset(ENTITY_NAMES)
+_FUNCTION_NAME_SET = frozenset(FUNCTION_NAMES)
+
+
+class ParsedTemplate(NamedTuple):
+    used: frozenset
+    renameable: Tuple[Tuple[str, tuple], ...]
+    functions: Tuple[str, ...]
+    tokens: tuple
+
+
+def _parse_template(code: str, template_vars: tuple):
+    """
+    Analyse a template once: its identifiers, which of its vars can be renamed
+    (and from which name pool), its top-level functions and its tokens.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
     
-    # Random function name substitution
-    if "def " in code:
-        for func in FUNCTION_NAMES[:5]:  # Check common function starts
-            if f"def {func}" in code or f"def get_" in code:
-                new_func = random.choice(FUNCTION_NAMES)
-                # Simple substitution - keeps it readable
-                break
+    used = frozenset(_identifiers(tree))
+    bound = frozenset(_bound_names(tree))
+    renameable = []
+    for name in template_vars:
+        if name in _ENTITY_NAME_SET and name in used:
+            renameable.append((name, ENTITY_NAMES))
+        elif name in bound and name.islower():
+            renameable.append((name, VARIABLE_NAMES))
+    
+    return ParsedTemplate(
+        used=used,
+        renameable=tuple(renameable),
+        functions=tuple(
+            node.name for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ),
+        tokens=tuple(tokenize.generate_tokens(io.StringIO(code).readline)),
+    )
+
+
+# Templates are parsed once at import; variations only apply renames to the tokens
+PARSED_TEMPLATES = [_parse_template(code, template_vars) for code, template_vars in zip(CODES, VARS)]
+
+
+def generate_variation(template_index: int, variation_index: int = 0) -> dict:
+    """
+    Generate a variation of the code template at `template_index`.
+    - Variation 0 is the template as written
+    - Others rename the variables, entity classes and function verb listed in
+      the template, seeded by `variation_index` so reruns are reproducible
+    """
+    code = CODES[template_index]
+    bug = BUGS[template_index]
+    parsed = PARSED_TEMPLATES[template_index]
+    if variation_index == 0 or parsed is None:
+        return {"code": code, "bug": bug}
+    
+    # Integer seeds skip the SHA-512 pass random.Random applies to string seeds
+    rng = random.Random(template_index << 32 | variation_index)
+    used = parsed.used
+    renames = {}
+    
+    def pick(pool, old):
+        taken = used | set(renames.values())
+        choices = [name for name in pool if name not in taken]
+        if choices:
+            renames[old] = rng.choice(choices)
+    
+    for name, pool in parsed.renameable:
+        pick(pool, name)
+    
+    # Swap the verb of top-level functions: get_user_email -> fetch_user_email
+    for function in parsed.functions:
+        verb, sep, rest = function.partition("_")
+        if sep and verb in _FUNCTION_NAME_SET:
+            taken = used | set(renames.values())
+            choices = [f"{v}_{rest}" for v in FUNCTION_NAMES if f"{v}_{rest}" not in taken]
+            if choices:
+                renames[function] = rng.choice(choices)
     
     return {
-        "code": code,
-        "bug": template["bug"],
+        "code": _rename_identifiers(parsed.tokens, renames) if renames else code,
+        "bug": bug,
     }
 
 
@@ -506,135 +701,432 @@ def generate_variation(template: dict) -> dict:
 # CLAUDE API
 # =============================================================================
 
-def generate_review(client: anthropic.Anthropic, code: str, bug_hint: str, category: str) -> str:
-    """Generate a code review using Claude Haiku."""
-    
-    prompt = f"""You are an expert Python code reviewer. Review this code and provide constructive feedback.
+REVIEW_INSTRUCTIONS = """You are an expert Python code reviewer. Review each numbered code snippet you are given and provide constructive feedback.
+
+Each snippet has an issue related to the category and hint given with it.
+
+For each snippet, write a concise, actionable code review comment (2-4 sentences). Be specific about:
+1. What the problem is
+2. What could go wrong
+3. How to fix it
+
+Do NOT use phrases like "Great code!" or "Nice work!". Be direct and technical.
+Do NOT include code blocks in your reviews - just explain in prose.
+Do NOT start with "The code" or "This code" - vary your openings.
+
+Respond with ONLY a JSON array of strings: one review per snippet, in snippet order."""
+
+# The instructions are identical for every request, so they go in the system
+# prompt marked for prompt caching; only the snippets vary per request
+SYSTEM_BLOCKS = [{"type": "text", "text": REVIEW_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}]
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
 
+SNIPPET_TEMPLATE = """Snippet {number}:
 The code has an issue related to: {category}
 Hint: {bug_hint}
 
-Code:
 ```python
 {code}
-```
+```"""
 
-Write a concise, actionable code review comment (2-4 sentences). Be specific about:
-1. What the problem is
-2. What could go wrong
-3. How to fix it
+# Fallback for responses that label each review instead of returning JSON
+SNIPPET_LABEL_RE = re.compile(r"^\s*\**Snippet \d+\**:\**\s*", re.MULTILINE)
 
-Do NOT use phrases like "Great code!" or "Nice work!". Be direct and technical.
-Do NOT include code blocks in your response - just explain in prose.
-Do NOT start with "The code" or "This code" - vary your opening."""
 
-    response = client.messages.create(
+class RateLimiter:
+    """
+    Spaces request starts `interval` seconds apart across all tasks, where the
+    interval is derived from the rate-limit headers of the latest response.
+    """
+
+    def __init__(self, interval: float = 0.0):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+        self._last_start = float("-inf")
+
+    def update(self, headers):
+        """Spread the remaining requests over the time left in the window when running low."""
+        remaining = headers.get("anthropic-ratelimit-requests-remaining")
+        reset = headers.get("anthropic-ratelimit-requests-reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset_at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+        except ValueError:
+            return
+        
+        if remaining >= RATE_LIMIT_HEADROOM:
+            self.interval = 0.0
+        else:
+            reset_seconds = max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+            self.interval = reset_seconds / max(remaining, 1)
+
+    async def wait(self):
+        """Sleep only for whatever part of the interval has not already elapsed."""
+        async with self._lock:
+            # Measured against the current interval, so headroom reported by a
+            # newer response releases waiting requests straight away
+            delay = self._last_start + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_start = time.monotonic()
+
+
+class JsonlWriter:
+    """
+    Appends JSON lines to a file from a background thread, so serialization and
+    write syscalls stay off the event loop. Lines are flushed whenever the
+    queue drains. If the thread fails (disk full, unserializable value), the
+    file is still closed and the error is re-raised from the next write() or
+    from close().
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, path: str, mode: str = "ab", maxsize: int = 1024):
+        self._f = open(path, mode)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                obj = self._queue.get()
+                if obj is self._CLOSE:
+                    break
+                self._f.write(_dumps(obj) + b"\n")
+                if self._queue.empty():
+                    self._f.flush()
+        except BaseException as e:
+            self._error = e
+        finally:
+            try:
+                self._f.close()
+            except OSError as e:
+                if self._error is None:
+                    self._error = e
+
+    def _put(self, obj):
+        """Queue `obj`, waiting for space only while the thread is still alive to drain it."""
+        while self._thread.is_alive():
+            try:
+                self._queue.put(obj, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        if self._error is not None:
+            raise self._error
+        raise RuntimeError(f"JSONL writer for {self._f.name} is closed")
+
+    def write(self, obj):
+        if self._error is not None:
+            raise self._error
+        self._put(obj)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._put(self._CLOSE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class ReviewCache:
+    """
+    Reviews keyed by a hash of the prompt inputs, persisted as an append-only
+    JSONL log so reruns skip prompts that were already answered. The dict it
+    loads doubles as the in-process memo: lookups never touch the API, and
+    duplicate prompts in a run are collapsed to one key before any request.
+    """
+
+    def __init__(self, path: str = REVIEW_CACHE_FILE):
+        self.path = Path(path)
+        self._reviews = {}
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = _loads(line)
+                    except ValueError:
+                        continue  # Partial line from an interrupted run
+                    self._reviews[entry["key"]] = entry["review"]
+        self._writer = JsonlWriter(self.path)
+
+    def __len__(self):
+        return len(self._reviews)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._reviews
+
+    @staticmethod
+    def key(code: str, bug_hint: str, category: str) -> str:
+        return hashlib.sha256(f"{MODEL}|{category}|{bug_hint}|{code}".encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        return self._reviews[key]
+
+    def put_many(self, items):
+        """Store (key, review) pairs and append them to the log."""
+        for key, review in items:
+            self._reviews[key] = review
+            self._writer.write({"key": key, "review": review})
+
+    def close(self):
+        self._writer.close()
+
+
+class TokenBudget:
+    """
+    Per-review max_tokens. Starts at MAX_TOKENS_PER_REVIEW, then after
+    AUTOTUNE_SAMPLE reviews drops to the p99 observed length plus headroom.
+    The tuned value is saved so reruns start from it; a truncated response
+    resets it to the default.
+    """
+
+    def __init__(self, path: str = TOKEN_BUDGET_FILE):
+        self.path = Path(path)
+        self.per_review = MAX_TOKENS_PER_REVIEW
+        self.tuned = False
+        self._samples = []
+        if self.path.exists():
+            self.per_review = _loads(self.path.read_bytes())["max_tokens_per_review"]
+            self.tuned = True
+
+    def record(self, output_tokens: int, reviews: int, truncated: bool):
+        """Record one response; each review counts as the batch's average length."""
+        if truncated:
+            self.per_review = MAX_TOKENS_PER_REVIEW
+            self._save()
+            return
+        if self.tuned:
+            return
+        
+        self._samples.extend([output_tokens / reviews] * reviews)
+        if len(self._samples) >= AUTOTUNE_SAMPLE:
+            p99 = statistics.quantiles(self._samples, n=100)[98]
+            self.per_review = min(MAX_TOKENS_PER_REVIEW, int(p99 * AUTOTUNE_HEADROOM) + 1)
+            self.tuned = True
+            self._save()
+            print(f"  max_tokens per review tuned to {self.per_review} (p99 {p99:.0f})")
+
+    def _save(self):
+        self.path.write_bytes(_dumps({"max_tokens_per_review": self.per_review}))
+
+
+def parse_reviews(text: str, expected: int) -> list:
+    """Extract `expected` reviews from a batched response."""
+    start, end = text.find("["), text.rfind("]")
+    try:
+        reviews = _loads(text[start:end + 1]) if start != -1 else None
+    except ValueError:
+        reviews = None
+    
+    if not isinstance(reviews, list):
+        reviews = [part for part in SNIPPET_LABEL_RE.split(text)[1:]]
+    
+    reviews = [r.strip() for r in reviews if isinstance(r, str) and r.strip()]
+    if len(reviews) != expected:
+        raise ValueError(f"Expected {expected} reviews, got {len(reviews)}")
+    return reviews
+
+
+async def generate_reviews(client: anthropic.AsyncAnthropic, snippets: list, limiter: RateLimiter = None,
+                           budget: TokenBudget = None) -> list:
+    """Generate code reviews for a batch of (code, bug_hint, category) snippets in one request."""
+    prompt = "\n\n".join(
+        SNIPPET_TEMPLATE.format_map({"number": n, "category": category, "bug_hint": bug_hint, "code": code})
+        for n, (code, bug_hint, category) in enumerate(snippets, 1)
+    )
+
+    raw = await client.messages.with_raw_response.create(
         model=MODEL,
-        max_tokens=200,
-        messages=[{"role": "user", "content": prompt}]
+        max_tokens=(budget.per_review if budget else MAX_TOKENS_PER_REVIEW) * len(snippets),
+        system=SYSTEM_BLOCKS,
+        messages=[{"role": "user", "content": prompt}],
+        extra_headers=PROMPT_CACHING_HEADERS
     )
+    if limiter is not None:
+        limiter.update(raw.headers)
+    response = raw.parse()
+    if budget is not None:
+        budget.record(response.usage.output_tokens, len(snippets), response.stop_reason == "max_tokens")
     
-    return response.content[0].text.strip()
+    return parse_reviews(response.content[0].text, len(snippets))
 
 
 # =============================================================================
 # MAIN GENERATOR
 # =============================================================================
 
-def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES):
-    """Generate synthetic training examples."""
+# System turn of every training example; one shared dict, never mutated
+REVIEWER_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are an expert code reviewer. Analyze the provided Python code and give constructive, specific feedback. Focus on bugs, potential issues, code quality, and improvements. Be direct and actionable."
+}
+
+
+def format_example(template_index: int, variation_index: int, variation: dict, review: str) -> dict:
+    """Format a generated review as a chat-style training example."""
+    return {
+        "messages": [
+            REVIEWER_SYSTEM_MESSAGE,
+            {
+                "role": "user", 
+                "content": f"Review this Python code:\n\n```python\n{variation['code']}\n```"
+            },
+            {
+                "role": "assistant",
+                "content": review
+            }
+        ],
+        "_meta": {
+            "source": "synthetic",
+            "category": CATEGORIES[template_index],
+            "bug_type": variation["bug"],
+            "template_id": template_index,
+            "variation_id": variation_index
+        }
+    }
+
+
+def load_checkpoint(path: str = CHECKPOINT_FILE):
+    """
+    Read an existing checkpoint and return the (template_id, variation_id) pairs
+    it already holds plus its stats. A partial last line from an interrupted
+    run is truncated so new examples append cleanly.
+    """
+    done = set()
+    stats = {"total": 0, "by_category": dict.fromkeys(TEMPLATE_INDEX_BY_CATEGORY, 0)}
+    if not Path(path).exists():
+        return done, stats
     
-    client = anthropic.Anthropic()  # Uses ANTHROPIC_API_KEY env var
+    complete = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            meta = _loads(line)["_meta"]
+            if "template_id" in meta:
+                done.add((meta["template_id"], meta["variation_id"]))
+            stats["total"] += 1
+            stats["by_category"][meta["category"]] = stats["by_category"].get(meta["category"], 0) + 1
+    
+    if complete != Path(path).stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(complete)
+    return done, stats
+
+
+async def request_reviews(client, semaphore, limiter, budget, snippets: list) -> list:
+    """Call the API for one batch of reviews once a concurrency slot and the pacing allow it."""
+    async with semaphore:
+        await limiter.wait()
+        return await generate_reviews(client, snippets, limiter, budget)
+
+
+async def generate_batch(client, semaphore, limiter, budget, cache, batch: list) -> list:
+    """Review a batch of (key, snippet) pairs and cache the results. Returns the keys reviewed."""
+    try:
+        reviews = await request_reviews(client, semaphore, limiter, budget, [snippet for _, snippet in batch])
+    except (anthropic.APIError, ValueError) as e:
+        print(f"  Error generating batch of {len(batch)} examples: {e}")
+        return []
+    
+    cache.put_many((key, review) for (key, _), review in zip(batch, reviews))
+    return [key for key, _ in batch]
+
+
+async def generate_synthetic_dataset_async(target_count: int = TARGET_EXAMPLES, fresh: bool = False):
+    """Generate synthetic training examples with concurrent API requests, resuming any checkpoint."""
+    
+    client = anthropic.AsyncAnthropic(max_retries=MAX_RETRIES)  # Uses ANTHROPIC_API_KEY env var
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter()
     
     Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+    cache = ReviewCache()
+    budget = TokenBudget()
+    if fresh and Path(CHECKPOINT_FILE).exists():
+        Path(CHECKPOINT_FILE).unlink()
+    done, stats = load_checkpoint()
     
-    examples = []
-    total_templates = sum(len(cat["templates"]) for cat in BUG_TEMPLATES)
+    total_templates = len(CODES)
     examples_per_template = target_count // total_templates + 1
     
     print("=" * 60)
     print("SYNTHETIC DATA GENERATOR")
     print("=" * 60)
     print(f"Target examples: {target_count}")
-    print(f"Bug categories: {len(BUG_TEMPLATES)}")
+    print(f"Bug categories: {len(TEMPLATE_INDEX_BY_CATEGORY)}")
     print(f"Total templates: {total_templates}")
     print(f"Examples per template: ~{examples_per_template}")
     print(f"Model: {MODEL}")
+    print(f"Concurrent requests: {MAX_CONCURRENT_REQUESTS}")
+    print(f"Snippets per request: {REVIEW_BATCH_SIZE}")
+    print(f"max_tokens per review: {budget.per_review}{' (tuned)' if budget.tuned else ''}")
+    print(f"Cached reviews: {len(cache)}")
+    print(f"Already in checkpoint: {len(done)}")
+    
+    # Plan every (template, variation) request up front, template by template,
+    # skipping pairs a previous run already wrote
+    work = [
+        (t, i)
+        for t in range(total_templates)
+        for i in range(examples_per_template)
+    ][:target_count]
+    work = [pair for pair in work if pair not in done]
+    
+    # Render every variation up front; identical prompts share one review and
+    # only prompts missing from the cache are sent, REVIEW_BATCH_SIZE per request
+    waiting = defaultdict(list)
+    misses = {}
+    for t, i in work:
+        category = CATEGORIES[t]
+        variation = generate_variation(t, i)
+        key = cache.key(variation["code"], variation["bug"], category)
+        waiting[key].append((t, i, variation))
+        if key not in cache:
+            misses[key] = (variation["code"], variation["bug"], category)
+    
+    batch_items = list(misses.items())
+    batches = [batch_items[n:n + REVIEW_BATCH_SIZE] for n in range(0, len(batch_items), REVIEW_BATCH_SIZE)]
+    print(f"Reviews to generate: {len(misses)} in {len(batches)} requests")
     print()
     
-    stats = {"total": 0, "by_category": {}}
+    # Each example is appended to the JSONL checkpoint as soon as its review is available
+    checkpoint = JsonlWriter(CHECKPOINT_FILE, "ab")
     
-    for category_data in BUG_TEMPLATES:
-        category = category_data["category"]
-        description = category_data["description"]
-        templates = category_data["templates"]
-        
-        print(f"\n[{category}] {description}")
-        stats["by_category"][category] = 0
-        
-        for template in templates:
-            # Generate multiple variations per template
-            for i in range(examples_per_template):
-                if stats["total"] >= target_count:
-                    break
+    def write_examples(keys):
+        for key in keys:
+            for t, i, variation in waiting.pop(key):
+                checkpoint.write(format_example(t, i, variation, cache.get(key)))
+                stats["total"] += 1
+                stats["by_category"][CATEGORIES[t]] += 1
                 
-                try:
-                    variation = generate_variation(template)
-                    
-                    review = generate_review(
-                        client,
-                        variation["code"],
-                        variation["bug"],
-                        category
-                    )
-                    
-                    # Format as training example
-                    example = {
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are an expert code reviewer. Analyze the provided Python code and give constructive, specific feedback. Focus on bugs, potential issues, code quality, and improvements. Be direct and actionable."
-                            },
-                            {
-                                "role": "user", 
-                                "content": f"Review this Python code:\n\n```python\n{variation['code']}\n```"
-                            },
-                            {
-                                "role": "assistant",
-                                "content": review
-                            }
-                        ],
-                        "_meta": {
-                            "source": "synthetic",
-                            "category": category,
-                            "bug_type": variation["bug"]
-                        }
-                    }
-                    
-                    examples.append(example)
-                    stats["total"] += 1
-                    stats["by_category"][category] += 1
-                    
-                    if stats["total"] % 50 == 0:
-                        print(f"  Generated {stats['total']}/{target_count} examples...")
-                        # Save checkpoint
-                        save_examples(examples, stats)
-                    
-                    time.sleep(DELAY_BETWEEN_REQUESTS)
-                    
-                except Exception as e:
-                    print(f"  Error generating example: {e}")
-                    time.sleep(2)  # Back off on error
-                    continue
-            
-            if stats["total"] >= target_count:
-                break
+                if stats["total"] % 50 == 0:
+                    print(f"  Generated {stats['total']}/{target_count} examples...")
+    
+    try:
+        write_examples([key for key in list(waiting) if key in cache])
         
-        if stats["total"] >= target_count:
-            break
+        tasks = [
+            asyncio.ensure_future(generate_batch(client, semaphore, limiter, budget, cache, batch))
+            for batch in batches
+        ]
+        for task in asyncio.as_completed(tasks):
+            write_examples(await task)
+    finally:
+        try:
+            checkpoint.close()
+        finally:
+            cache.close()
     
     # Final save
-    save_examples(examples, stats)
+    examples = save_examples(stats)
     
     print("\n" + "=" * 60)
     print("GENERATION COMPLETE")
@@ -646,54 +1138,86 @@ def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES):
     return examples, stats
 
 
-def save_examples(examples: list, stats: dict):
-    """Save examples to file."""
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump({
+def generate_synthetic_dataset(target_count: int = TARGET_EXAMPLES, fresh: bool = False):
+    """Generate synthetic training examples."""
+    return asyncio.run(generate_synthetic_dataset_async(target_count, fresh))
+
+
+def save_examples(stats: dict) -> list:
+    """Collect the JSONL checkpoint into the summary file and return the examples."""
+    examples = []
+    with open(CHECKPOINT_FILE, "rb") as f:
+        for line in f:
+            examples.append(_loads(line))
+    
+    with open(OUTPUT_FILE, "wb") as f:
+        f.write(_dumps({
             "generated_at": datetime.now().isoformat(),
             "model": MODEL,
             "stats": stats,
             "examples": examples
-        }, f, indent=2)
+        }, indent=True))
+    
+    return examples
+
+
+def _line_offsets(path: str) -> list:
+    """Byte offset of every non-empty line in a JSONL file."""
+    offsets = []
+    pos = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                offsets.append(pos)
+            pos += len(line)
+    return offsets
 
 
-def convert_to_training_format(input_file: str = OUTPUT_FILE, output_dir: str = "data/processed"):
+def convert_to_training_format(input_file: str = CHECKPOINT_FILE, output_dir: str = "data/processed"):
     """Convert synthetic examples to JSONL and merge with existing data."""
     
     print(f"\nConverting {input_file} to training format...")
     
-    with open(input_file) as f:
-        data = json.load(f)
+    synthetic_jsonl = f"{output_dir}/synthetic.jsonl"
+    if input_file == CHECKPOINT_FILE and not Path(input_file).exists() and Path(OUTPUT_FILE).exists():
+        # No checkpoint yet, e.g. data generated before it existed: fall back to the summary file
+        print(f"{input_file} not found, using {OUTPUT_FILE}")
+        input_file = OUTPUT_FILE
     
-    synthetic_examples = data["examples"]
-    print(f"Loaded {len(synthetic_examples)} synthetic examples")
+    if input_file.endswith(".jsonl"):
+        # The checkpoint is already one example per line, so copy it straight through
+        shutil.copyfile(input_file, synthetic_jsonl)
+    else:
+        with open(input_file, "rb") as f:
+            examples = _loads(f.read())["examples"]
+        with open(synthetic_jsonl, "wb") as f:
+            for ex in examples:
+                f.write(_dumps(ex) + b"\n")
     
-    # Save as separate JSONL
-    synthetic_jsonl = f"{output_dir}/synthetic.jsonl"
-    with open(synthetic_jsonl, "w") as f:
-        for ex in synthetic_examples:
-            f.write(json.dumps(ex) + "\n")
+    synthetic_offsets = _line_offsets(synthetic_jsonl)
+    print(f"Loaded {len(synthetic_offsets)} synthetic examples")
     print(f"Saved to {synthetic_jsonl}")
     
     # Merge with existing training data
     existing_train = f"{output_dir}/train.jsonl"
     merged_train = f"{output_dir}/train_with_synthetic.jsonl"
     
-    existing_examples = []
-    with open(existing_train) as f:
-        for line in f:
-            existing_examples.append(json.loads(line))
-    
-    print(f"Existing training examples: {len(existing_examples)}")
+    existing_offsets = _line_offsets(existing_train)
+    print(f"Existing training examples: {len(existing_offsets)}")
     
-    # Combine and shuffle
-    combined = existing_examples + synthetic_examples
-    random.seed(42)
-    random.shuffle(combined)
+    # Shuffle (file, offset) pairs instead of parsed examples, then copy each
+    # line across by seeking to it; only the offsets are held in memory
+    combined = [(0, off) for off in existing_offsets] + [(1, off) for off in synthetic_offsets]
+    random.Random(42).shuffle(combined)
     
-    with open(merged_train, "w") as f:
-        for ex in combined:
-            f.write(json.dumps(ex) + "\n")
+    with open(existing_train, "rb") as existing, open(synthetic_jsonl, "rb") as synthetic, \
+            open(merged_train, "wb") as out:
+        sources = (existing, synthetic)
+        for source, offset in combined:
+            f = sources[source]
+            f.seek(offset)
+            line = f.readline()
+            out.write(line if line.endswith(b"\n") else line + b"\n")
     
     print(f"Merged dataset: {len(combined)} examples")
     print(f"Saved to {merged_train}")
@@ -707,12 +1231,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate synthetic code review data")
     parser.add_argument("--count", type=int, default=TARGET_EXAMPLES, help="Number of examples to generate")
     parser.add_argument("--convert-only", action="store_true", help="Only convert existing synthetic data")
+    parser.add_argument("--fresh", action="store_true", help="Discard the existing checkpoint instead of resuming it")
     
     args = parser.parse_args()
     
     if args.convert_only:
         convert_to_training_format()
     else:
-        generate_synthetic_dataset(args.count)
+        generate_synthetic_dataset(args.count, args.fresh)
         print("\nTo merge with training data, run:")
         print("  python generate_synthetic.py --convert-only")
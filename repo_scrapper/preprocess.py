@@ -6,8 +6,64 @@ Converts raw data into prompt-completion pairs for fine-tuning.
 import json
 import random
 import re
+from collections import Counter
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Compiled once at import; clean_comment runs for every scraped comment.
+# Mentions, images and links are stripped in a single pass over the text.
+_MENTION_RE = re.compile(r"@[\w-]+")
+# Mentions may sit between the markdown brackets (e.g. "!@user[..]"), which
+# the old mention-first pass would have joined up, so the gaps allow them.
+_GAP = r"(?:@[\w-]+)*"
+_CLEANUP_RE = re.compile(
+    r"(?P<img>!" + _GAP + r"\[.*?\]" + _GAP + r"\(.*?\))"
+    r"|(?P<link>\[(?P<text>.*?)\]" + _GAP + r"\(.*?\))"
+    r"|(?P<mention>@[\w-]+)"
+)
+_MULTINL_RE = re.compile(r"\n{3,}")
+
+# Output files are written through one large buffer rather than per-record writes
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Prompt text shared by every formatted example
+SYSTEM_PROMPT = "You are an expert code reviewer. Analyze the provided Python code and give constructive, specific feedback. Focus on bugs, potential issues, code quality, and improvements. Be direct and actionable."
+ALPACA_INSTRUCTION = "Review the following Python code and provide constructive, specific feedback on potential bugs, issues, and improvements."
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+_USER_PREFIX = "Review this Python code from `"
+_USER_MID = "`:\n\n```python\n"
+_USER_SUFFIX = "\n```"
+
+
+def _cleanup_sub(match: re.Match) -> str:
+    """Drop mentions and images; replace links with their (mention-free) text."""
+    if match.lastgroup == "link":
+        return _MENTION_RE.sub("", match.group("text"))
+    return ""
+
+
+def _dumps(obj, indent: bool = False) -> bytes:
+    """Serialize `obj` to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _loads(data):
+    """Parse JSON text or bytes, using orjson when it is installed."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 
 def clean_diff_hunk(diff_hunk: str) -> str:
     """
@@ -17,22 +73,13 @@ def clean_diff_hunk(diff_hunk: str) -> str:
     if not diff_hunk:
         return ""
     
-    lines = diff_hunk.split("\n")
-    cleaned_lines = []
-    
-    for line in lines:
-        # Skip diff header lines
-        if line.startswith("@@"):
-            continue
-        # Remove the +/- prefix but keep the line
-        if line.startswith("+") or line.startswith("-"):
-            cleaned_lines.append(line[1:])
-        elif line.startswith(" "):
-            cleaned_lines.append(line[1:])
-        else:
-            cleaned_lines.append(line)
-    
-    return "\n".join(cleaned_lines).strip()
+    # Skip "@@" header lines and drop the one-character +/-/space prefix
+    # (an empty line's "" slice is harmlessly "in" the prefix set too)
+    return "\n".join(
+        line[1:] if line[:1] in "+- " else line
+        for line in diff_hunk.split("\n")
+        if not line.startswith("@@")
+    ).strip()
 
 
 def clean_comment(comment: str) -> str:
@@ -43,17 +90,11 @@ def clean_comment(comment: str) -> str:
     if not comment:
         return ""
     
-    # Remove GitHub @mentions
-    comment = re.sub(r"@[\w-]+", "", comment)
-    
-    # Remove image links
-    comment = re.sub(r"!\[.*?\]\(.*?\)", "", comment)
-    
-    # Remove regular links but keep text
-    comment = re.sub(r"\[(.*?)\]\(.*?\)", r"\1", comment)
+    # Remove GitHub @mentions and image links, keep the text of regular links
+    comment = _CLEANUP_RE.sub(_cleanup_sub, comment)
     
     # Clean up excessive whitespace
-    comment = re.sub(r"\n{3,}", "\n\n", comment)
+    comment = _MULTINL_RE.sub("\n\n", comment)
     comment = comment.strip()
     
     return comment
@@ -77,20 +118,24 @@ def is_quality_example(code: str, comment: str) -> tuple[bool, str]:
         return False, "comment_too_long"
     
     # Skip if comment is mostly code (likely a suggestion, not explanation)
-    code_block_ratio = comment.count("```") / max(len(comment), 1)
-    if code_block_ratio > 0.01 and comment.count("```") >= 4:
+    # (more than one fence per 100 characters, and at least two blocks)
+    triple_ticks = comment.count("```")
+    if triple_ticks >= 4 and triple_ticks * 100 > len(comment):
         return False, "mostly_code_blocks"
     
-    # Skip non-English (rough heuristic)
-    ascii_ratio = sum(1 for c in comment if ord(c) < 128) / max(len(comment), 1)
-    if ascii_ratio < 0.8:
-        return False, "likely_non_english"
-    
     # Skip if just asking a question (not giving feedback)
     lower_comment = comment.lower().strip()
-    if lower_comment.endswith("?") and comment.count("?") > comment.count("."):
+    if lower_comment.endswith("?") and lower_comment.count("?") > lower_comment.count("."):
         return False, "mostly_questions"
     
+    # Skip non-English (rough heuristic: more than 20% non-ASCII characters).
+    # Most comments are pure ASCII, which isascii() confirms without a Python loop.
+    # Checked after the cheaper gates so rejected comments never pay for it.
+    if not comment.isascii():
+        non_ascii = sum(1 for c in comment if ord(c) >= 128)
+        if non_ascii * 5 > len(comment):
+            return False, "likely_non_english"
+    
     # Skip boilerplate/administrative comments (not insightful code review)
     boilerplate_phrases = [
         "copyright",
@@ -171,19 +216,13 @@ def format_training_example(code: str, comment: str, file_path: str) -> dict:
     """
     
     # Extract filename for context
-    filename = file_path.split("/")[-1] if file_path else "code.py"
+    filename = file_path.rpartition("/")[2] if file_path else "code.py"
     
-    system_prompt = "You are an expert code reviewer. Analyze the provided Python code and give constructive, specific feedback. Focus on bugs, potential issues, code quality, and improvements. Be direct and actionable."
-    
-    user_prompt = f"""Review this Python code from `{filename}`:
-
-```python
-{code}
-```"""
+    user_prompt = _USER_PREFIX + filename + _USER_MID + code + _USER_SUFFIX
 
     return {
         "messages": [
-            {"role": "system", "content": system_prompt},
+            _SYSTEM_MESSAGE,
             {"role": "user", "content": user_prompt},
             {"role": "assistant", "content": comment}
         ]
@@ -195,37 +234,64 @@ def format_alpaca_style(code: str, comment: str, file_path: str) -> dict:
     Alternative format: Alpaca-style instruction/input/output.
     Some training frameworks prefer this.
     """
-    filename = file_path.split("/")[-1] if file_path else "code.py"
+    filename = file_path.rpartition("/")[2] if file_path else "code.py"
     
     return {
-        "instruction": "Review the following Python code and provide constructive, specific feedback on potential bugs, issues, and improvements.",
+        "instruction": ALPACA_INSTRUCTION,
         "input": f"File: {filename}\n\n```python\n{code}\n```",
         "output": comment
     }
 
 
+def write_jsonl(path: str, records: list):
+    """Write records as compact JSON lines through a single buffered writer."""
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines(_dumps(ex) + b"\n" for ex in records)
+
+
+def iter_examples(input_file: str):
+    """
+    Stream raw scraped examples one at a time.
+    Accepts the scraper's JSON-lines output or a legacy {"examples": [...]} JSON file;
+    the latter is streamed with ijson when installed, otherwise loaded whole.
+    """
+    with open(input_file, "rb") as f:
+        if input_file.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield _loads(line)
+        elif ijson is not None:
+            yield from ijson.items(f, "examples.item", use_float=True)
+        else:
+            yield from _loads(f.read())["examples"]
+
+
 def process_dataset(
-    input_file: str = "data/all_examples.json",
+    input_file: str = "data/all_examples.jsonl",
     output_dir: str = "data/processed",
     train_ratio: float = 0.9,
-    format_type: str = "chatml"  # "chatml" or "alpaca"
+    format_type: str = "chatml",  # "chatml" or "alpaca"
+    include_meta: bool = False
 ):
     """
     Process the raw dataset into training format.
     Splits into train/eval sets.
+    Source metadata (`_meta`) is only attached when include_meta is set.
     """
-    print(f"Loading data from {input_file}...")
-    with open(input_file) as f:
-        data = json.load(f)
+    legacy_file = str(Path(input_file).with_suffix(".json"))
+    if input_file.endswith(".jsonl") and not Path(input_file).exists() and Path(legacy_file).exists():
+        # Data scraped before the JSONL output only has the legacy JSON file
+        print(f"{input_file} not found, using {legacy_file}")
+        input_file = legacy_file
     
-    examples = data["examples"]
-    print(f"Loaded {len(examples)} raw examples")
+    print(f"Loading data from {input_file}...")
     
-    # Process and filter
+    # Process and filter as examples are parsed, so the raw input is never held in memory
     processed = []
-    stats = {"total": len(examples), "kept": 0, "filtered": {}}
+    stats = {"total": 0, "kept": 0, "filtered": Counter()}
     
-    for ex in examples:
+    for ex in iter_examples(input_file):
+        stats["total"] += 1
         code = clean_diff_hunk(ex.get("diff_hunk", ""))
         comment = clean_comment(ex.get("comment", ""))
         file_path = ex.get("file_path", "")
@@ -234,7 +300,7 @@ def process_dataset(
         passed, reason = is_quality_example(code, comment)
         
         if not passed:
-            stats["filtered"][reason] = stats["filtered"].get(reason, 0) + 1
+            stats["filtered"][reason] += 1
             continue
         
         # Format based on chosen style
@@ -244,27 +310,29 @@ def process_dataset(
             formatted = format_alpaca_style(code, comment, file_path)
         
         # Add metadata for debugging (won't be used in training)
-        formatted["_meta"] = {
-            "repo": ex.get("repo"),
-            "pr_number": ex.get("pr_number"),
-            "url": ex.get("url")
-        }
+        if include_meta:
+            formatted["_meta"] = {
+                "repo": ex.get("repo"),
+                "pr_number": ex.get("pr_number"),
+                "url": ex.get("url")
+            }
         
         processed.append(formatted)
         stats["kept"] += 1
     
+    print(f"Loaded {stats['total']} raw examples")
     print(f"\nProcessing complete:")
     print(f"  Kept: {stats['kept']}")
     print(f"  Filtered: {sum(stats['filtered'].values())}")
     print(f"  Filter breakdown: {json.dumps(stats['filtered'], indent=4)}")
     
-    # Shuffle and split
-    random.seed(42)
-    random.shuffle(processed)
-    
+    # Shuffle and split: the input is grouped by repo, so both sets are written
+    # in shuffled order (seeded locally, so the global RNG is untouched)
+    order = list(range(len(processed)))
+    random.Random(42).shuffle(order)
     split_idx = int(len(processed) * train_ratio)
-    train_data = processed[:split_idx]
-    eval_data = processed[split_idx:]
+    train_data = [processed[i] for i in order[:split_idx]]
+    eval_data = [processed[i] for i in order[split_idx:]]
     
     print(f"\nSplit:")
     print(f"  Train: {len(train_data)}")
@@ -276,23 +344,18 @@ def process_dataset(
     train_file = f"{output_dir}/train.jsonl"
     eval_file = f"{output_dir}/eval.jsonl"
     
-    with open(train_file, "w") as f:
-        for ex in train_data:
-            f.write(json.dumps(ex) + "\n")
-    
-    with open(eval_file, "w") as f:
-        for ex in eval_data:
-            f.write(json.dumps(ex) + "\n")
+    write_jsonl(train_file, train_data)
+    write_jsonl(eval_file, eval_data)
     
     # Also save a combined JSON for inspection
-    with open(f"{output_dir}/all_processed.json", "w") as f:
-        json.dump({
+    with open(f"{output_dir}/all_processed.json", "wb") as f:
+        f.write(_dumps({
             "format": format_type,
             "stats": stats,
             "train_count": len(train_data),
             "eval_count": len(eval_data),
             "examples": processed[:10]  # First 10 for inspection
-        }, f, indent=2)
+        }, indent=True))
     
     print(f"\nSaved:")
     print(f"  {train_file} ({len(train_data)} examples)")
@@ -308,13 +371,20 @@ def preview_examples(input_file: str = "data/processed/train.jsonl", n: int = 3)
     print(f"PREVIEWING {n} EXAMPLES")
     print(f"{'='*60}\n")
     
-    with open(input_file) as f:
-        lines = f.readlines()
-    
-    samples = random.sample(lines, min(n, len(lines)))
+    # Reservoir sample so only `n` lines are ever held in memory
+    samples = []
+    with open(input_file, "rb") as f:
+        for i, line in enumerate(f):
+            if i < n:
+                samples.append(line)
+            else:
+                j = random.randrange(i + 1)
+                if j < n:
+                    samples[j] = line
+    random.shuffle(samples)
     
     for i, line in enumerate(samples, 1):
-        ex = json.loads(line)
+        ex = _loads(line)
         print(f"--- Example {i} ---")
         
         if "messages" in ex:  # ChatML format
@@ -337,17 +407,19 @@ if __name__ == "__main__":
     import argparse
     
     parser = argparse.ArgumentParser(description="Preprocess code review data")
-    parser.add_argument("--input", default="data/all_examples.json", help="Input JSON file")
+    parser.add_argument("--input", default="data/all_examples.jsonl", help="Input JSONL (or legacy JSON) file; falls back to the .json file if the .jsonl is missing")
     parser.add_argument("--output", default="data/processed", help="Output directory")
     parser.add_argument("--format", choices=["chatml", "alpaca"], default="chatml", help="Output format")
     parser.add_argument("--preview", action="store_true", help="Preview examples after processing")
+    parser.add_argument("--include-meta", action="store_true", help="Keep source repo/PR metadata on each example")
     
     args = parser.parse_args()
     
     train_data, eval_data, stats = process_dataset(
         input_file=args.input,
         output_dir=args.output,
-        format_type=args.format
+        format_type=args.format,
+        include_meta=args.include_meta
     )
     
     if args.preview:
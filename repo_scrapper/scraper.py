@@ -4,13 +4,23 @@ Collects code review comments from high-quality repos for fine-tuning.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple, Optional
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load the .env file
 load_dotenv()
 
@@ -24,6 +34,14 @@ HEADERS = {
 
 BASE_URL = "https://api.github.com"
 
+# PR comment fetches are I/O-bound; GitHub's limit is per hour, so a small pool is safe
+MAX_WORKERS = 12
+
+# One keep-alive session for every API call, so PRs don't each pay a new TLS handshake
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(BASE_URL, HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
 # Target repos - high quality Python projects with good review culture
 TARGET_REPOS = [
     "fastapi/fastapi",
@@ -49,15 +67,54 @@ MIN_COMMENT_LENGTH = 50  # Skip short comments like "LGTM", "nit"
 MAX_COMMENT_LENGTH = 2000  # Skip overly long comments (usually not focused)
 MIN_CODE_CONTEXT_LINES = 3
 
+# Common low-value openers, matched in one pass; the matched text names the pattern
+_SKIP_RE = re.compile(r"^(lgtm|looks good|nit[: ]|\+1|thanks!|thank you|nice!|great!|awesome|ship it|approved)")
+
+# Combined output: examples are appended as JSON lines after each repo,
+# while the manifest only carries the (small) running stats
+EXAMPLES_FILE = "data/all_examples.jsonl"
+MANIFEST_FILE = "data/manifest.json"
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def _dumps(obj):
+    """Serialize `obj` to compact UTF-8 JSON bytes, using orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+# Cleared while one thread sleeps off a low rate limit; every request waits on it
+_rate_limit_ok = threading.Event()
+_rate_limit_ok.set()
+_rate_limit_lock = threading.Lock()
+
 
 def rate_limit_check(response):
-    """Check rate limit and sleep if needed."""
+    """Check rate limit and sleep if needed (one thread sleeps, the rest wait)."""
     remaining = int(response.headers.get("X-RateLimit-Remaining", 1))
     if remaining < 10:
-        reset_time = int(response.headers.get("X-RateLimit-Reset", 0))
-        sleep_time = max(reset_time - time.time(), 0) + 5
-        print(f"Rate limit low ({remaining}). Sleeping {sleep_time:.0f}s...")
-        time.sleep(sleep_time)
+        if not _rate_limit_lock.acquire(blocking=False):
+            # Another worker is already sleeping until the reset
+            _rate_limit_ok.wait()
+            return
+        try:
+            _rate_limit_ok.clear()
+            reset_time = int(response.headers.get("X-RateLimit-Reset", 0))
+            sleep_time = max(reset_time - time.time(), 0) + 5
+            print(f"Rate limit low ({remaining}). Sleeping {sleep_time:.0f}s...")
+            time.sleep(sleep_time)
+        finally:
+            _rate_limit_ok.set()
+            _rate_limit_lock.release()
+
+
+def api_get(url, params):
+    """GET a GitHub API URL once any rate-limit pause is over."""
+    _rate_limit_ok.wait()
+    response = SESSION.get(url, params=params)
+    rate_limit_check(response)
+    return response
 
 
 def get_merged_prs(repo, per_page=100, max_prs=500):
@@ -75,8 +132,7 @@ def get_merged_prs(repo, per_page=100, max_prs=500):
             "page": page
         }
         
-        response = requests.get(url, headers=HEADERS, params=params)
-        rate_limit_check(response)
+        response = api_get(url, params)
         
         if response.status_code != 200:
             print(f"Error fetching PRs from {repo}: {response.status_code}")
@@ -110,8 +166,7 @@ def get_pr_review_comments(repo, pr_number):
     
     while True:
         params = {"per_page": 100, "page": page}
-        response = requests.get(url, headers=HEADERS, params=params)
-        rate_limit_check(response)
+        response = api_get(url, params)
         
         if response.status_code != 200:
             break
@@ -133,6 +188,16 @@ def get_pr_review_comments(repo, pr_number):
 
 def filter_comment(comment):
     """Filter out low-quality comments."""
+    # Cheap structural checks first, so most rejects never touch the body
+    # Only Python files
+    path = comment.get("path", "")
+    if not path.endswith(".py"):
+        return False, "not_python"
+    
+    # Must have code context
+    if not comment.get("diff_hunk"):
+        return False, "no_diff_hunk"
+    
     body = comment.get("body", "")
     
     # Length checks
@@ -142,53 +207,44 @@ def filter_comment(comment):
         return False, "too_long"
     
     # Skip common low-value patterns
-    lower_body = body.lower().strip()
-    skip_patterns = [
-        "lgtm",
-        "looks good",
-        "nit:",
-        "nit ",
-        "+1",
-        "thanks!",
-        "thank you",
-        "nice!",
-        "great!",
-        "awesome",
-        "ship it",
-        "approved",
-    ]
-    
-    for pattern in skip_patterns:
-        if lower_body.startswith(pattern) and len(body) < 100:
-            return False, f"skip_pattern:{pattern}"
-    
-    # Must have code context
-    if not comment.get("diff_hunk"):
-        return False, "no_diff_hunk"
-    
-    # Only Python files
-    path = comment.get("path", "")
-    if not path.endswith(".py"):
-        return False, "not_python"
+    if len(body) < 100:
+        match = _SKIP_RE.match(body.lower().strip())
+        if match:
+            return False, f"skip_pattern:{match.group(1)}"
     
     return True, "ok"
 
 
+class TrainingExample(NamedTuple):
+    """One kept review comment; a tuple, so no per-example dict until it is written."""
+    repo: str
+    pr_number: int
+    file_path: Optional[str]
+    line: Optional[int]
+    side: Optional[str]  # LEFT or RIGHT
+    diff_hunk: Optional[str]
+    comment: Optional[str]
+    comment_id: Optional[int]
+    user: Optional[str]
+    created_at: Optional[str]
+    url: Optional[str]
+
+
 def extract_training_example(comment, repo, pr_number):
     """Convert a review comment into a training example."""
-    return {
-        "repo": repo,
-        "pr_number": pr_number,
-        "file_path": comment.get("path"),
-        "line": comment.get("original_line") or comment.get("line"),
-        "side": comment.get("side"),  # LEFT or RIGHT
-        "diff_hunk": comment.get("diff_hunk"),
-        "comment": comment.get("body"),
-        "comment_id": comment.get("id"),
-        "user": comment.get("user", {}).get("login"),
-        "created_at": comment.get("created_at"),
-        "url": comment.get("html_url"),
-    }
+    return TrainingExample(
+        repo,
+        pr_number,
+        comment.get("path"),
+        comment.get("original_line") or comment.get("line"),
+        comment.get("side"),
+        comment.get("diff_hunk"),
+        comment.get("body"),
+        comment.get("id"),
+        comment.get("user", {}).get("login"),
+        comment.get("created_at"),
+        comment.get("html_url"),
+    )
 
 
 def scrape_repo(repo, max_prs=500, output_dir="data"):
@@ -205,27 +261,26 @@ def scrape_repo(repo, max_prs=500, output_dir="data"):
     examples = []
     stats = {"total_comments": 0, "filtered": {}, "kept": 0}
     
-    for i, pr in enumerate(prs):
-        pr_number = pr["number"]
+    # Fetch review comments concurrently; results come back in PR order
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        all_comments = pool.map(lambda pr: get_pr_review_comments(repo, pr["number"]), prs)
         
-        # Get review comments
-        comments = get_pr_review_comments(repo, pr_number)
-        stats["total_comments"] += len(comments)
-        
-        for comment in comments:
-            passed, reason = filter_comment(comment)
+        for i, (pr, comments) in enumerate(zip(prs, all_comments)):
+            pr_number = pr["number"]
+            stats["total_comments"] += len(comments)
             
-            if passed:
-                example = extract_training_example(comment, repo, pr_number)
-                examples.append(example)
-                stats["kept"] += 1
-            else:
-                stats["filtered"][reason] = stats["filtered"].get(reason, 0) + 1
-        
-        if (i + 1) % 50 == 0:
-            print(f"  Processed {i+1}/{len(prs)} PRs, {stats['kept']} examples collected")
-        
-        time.sleep(0.2)
+            for comment in comments:
+                passed, reason = filter_comment(comment)
+                
+                if passed:
+                    example = extract_training_example(comment, repo, pr_number)
+                    examples.append(example)
+                    stats["kept"] += 1
+                else:
+                    stats["filtered"][reason] = stats["filtered"].get(reason, 0) + 1
+            
+            if (i + 1) % 50 == 0:
+                print(f"  Processed {i+1}/{len(prs)} PRs, {stats['kept']} examples collected")
     
     # Save to file
     Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -237,7 +292,7 @@ def scrape_repo(repo, max_prs=500, output_dir="data"):
             "repo": repo,
             "scraped_at": datetime.now().isoformat(),
             "stats": stats,
-            "examples": examples
+            "examples": [example._asdict() for example in examples]
         }, f, indent=2)
     
     print(f"\nRepo complete: {repo}")
@@ -255,38 +310,44 @@ def main():
     print(f"Target repos: {len(TARGET_REPOS)}")
     print(f"Token: {'*' * 10}{GITHUB_TOKEN[-4:]}")
     
-    all_examples = []
+    total_examples = 0
     all_stats = {"total_comments": 0, "kept": 0, "by_repo": {}}
+    scraped_at = datetime.now().isoformat()  # run start, shared by every checkpoint
     
-    for repo in TARGET_REPOS:
-        try:
-            examples, stats = scrape_repo(repo, max_prs=1000)
-            all_examples.extend(examples)
-            all_stats["total_comments"] += stats["total_comments"]
-            all_stats["kept"] += stats["kept"]
-            all_stats["by_repo"][repo] = stats["kept"]
-        except Exception as e:
-            print(f"Error scraping {repo}: {e}")
-            continue
-        
-        # Save combined file periodically
-        with open("data/all_examples.json", "w") as f:
-            json.dump({
-                "scraped_at": datetime.now().isoformat(),
-                "total_examples": len(all_examples),
-                "stats": all_stats,
-                "examples": all_examples
-            }, f, indent=2)
-        
-        print(f"\n>>> Running total: {len(all_examples)} examples")
-        time.sleep(1)
+    Path(EXAMPLES_FILE).parent.mkdir(parents=True, exist_ok=True)
+    with open(EXAMPLES_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as out:
+        for repo in TARGET_REPOS:
+            try:
+                examples, stats = scrape_repo(repo, max_prs=1000)
+                all_stats["total_comments"] += stats["total_comments"]
+                all_stats["kept"] += stats["kept"]
+                all_stats["by_repo"][repo] = stats["kept"]
+            except Exception as e:
+                print(f"Error scraping {repo}: {e}")
+                continue
+            
+            # Append this repo's examples, then checkpoint the stats
+            out.writelines(_dumps(example._asdict()) + b"\n" for example in examples)
+            out.flush()
+            total_examples += len(examples)
+            
+            with open(MANIFEST_FILE, "w") as f:
+                json.dump({
+                    "scraped_at": scraped_at,
+                    "total_examples": total_examples,
+                    "examples_file": EXAMPLES_FILE,
+                    "stats": all_stats,
+                }, f, indent=2)
+            
+            print(f"\n>>> Running total: {total_examples} examples")
+            time.sleep(1)
     
     print("\n" + "="*60)
     print("SCRAPING COMPLETE")
     print("="*60)
-    print(f"Total examples collected: {len(all_examples)}")
+    print(f"Total examples collected: {total_examples}")
     print(f"By repo: {json.dumps(all_stats['by_repo'], indent=2)}")
-    print(f"Saved to: data/all_examples.json")
+    print(f"Saved to: {EXAMPLES_FILE} (stats in {MANIFEST_FILE})")
 
 
 if __name__ == "__main__":